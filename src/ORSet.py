@@ -1,85 +1,146 @@
-from datetime import datetime
 import uuid
 import hashlib
 
+REPLICA_ID = uuid.uuid4().hex[:8]  # Identifies this process in the dots it creates
+
 class ShoppingListORSet:
-    def __init__(self, listID=None):
+    def __init__(self, listID=None, replica_id=None):
         # Unique ID for each shopping list (auto-generated if not provided)
         self.listID = listID if listID else hashlib.sha256(str(uuid.uuid4()).encode('utf-8')).hexdigest()
-        self.add_set = set()  # Stores tuples of (item_name, target_quantity, tag)
-        self.remove_set = set()  # Stores tuples of (item_name, target_quantity, tag)
-        self.processed_tags = set() 
+        self.replica_id = replica_id if replica_id else REPLICA_ID
+        # item_name -> {replica_id: (counter, added, removed)}, the latest dot of each replica for the item
+        # together with everything that replica added and removed for it so far
+        self.items = {}
+        self.vv = {}  # Version vector: replica_id -> last counter seen from that replica
+        self.totals = {}  # Materialized view: item_name -> [added, removed] summed over all replicas
+        self.replica_items = {}  # Index: replica_id -> names of the items that replica has an entry for
+
+    def _next_dot(self):
+        """Generate the next dot (replica_id, counter) of this replica."""
+        counter = self.vv.get(self.replica_id, 0) + 1
+        self.vv[self.replica_id] = counter
+        return counter
+
+    def _set_entry(self, item_name, replica_id, entry):
+        """Replace the entry of a replica for an item, updating the view by the difference."""
+        dots = self.items.setdefault(item_name, {})
+        _, old_added, old_removed = dots.get(replica_id, (0, 0, 0))
+        if replica_id not in dots:
+            self.replica_items.setdefault(replica_id, set()).add(item_name)
+        dots[replica_id] = entry
+        totals = self.totals.setdefault(item_name, [0, 0])
+        totals[0] += entry[1] - old_added
+        totals[1] += entry[2] - old_removed
 
-    def _generate_tag(self):
-        """Generate a unique tag for each item (UUID + timestamp)."""
-        return f"{uuid.uuid4()}-{datetime.now().isoformat()}"
+    def _update(self, item_name, added, removed):
+        counter = self._next_dot()
+        _, total_added, total_removed = self.items.get(item_name, {}).get(self.replica_id, (0, 0, 0))
+        self._set_entry(item_name, self.replica_id, (counter, total_added + added, total_removed + removed))
+
+    def _has_item(self, item_name):
+        return item_name in self.totals and self.totals[item_name][0] > 0
 
     def add_item(self, item_name, target_quantity):
         """Add an item with a target quantity to the shopping list."""
-        tag = self._generate_tag()
-        self.add_set.add((item_name, target_quantity, tag))
-        self.processed_tags.add(tag)
+        self._update(item_name, target_quantity, 0)
 
     def remove_item(self, item_name, quantity_acquired):
         """Remove a specified quantity of an item from the shopping list."""
-        tag = self._generate_tag()
-        items_to_remove = [(i, qty, t) for (i, qty, t) in self.add_set if i == item_name]
-
-        if not items_to_remove:
+        if not self._has_item(item_name):
             return -1
         else:
-            self.remove_set.add((item_name, quantity_acquired, tag))
-            self.processed_tags.add(tag)
-    
-    
+            self._update(item_name, 0, quantity_acquired)
+
+
     def get_list(self):
         """Get the current items in the shopping list with their quantities."""
-        items = {}
-        for item_name, qty, _ in self.add_set:
-            if item_name in items:
-                items[item_name] += qty
-            else:
-                items[item_name] = qty
+        items = {item_name: added - removed for item_name, (added, removed) in self.totals.items() if added > 0}
+        return items.items()
 
-        for item_name, qty, _ in self.remove_set:
-            if item_name in items:
-                items[item_name] -= qty
+    def delta(self, since):
+        """Serialize only the entries newer than the version vector `since`."""
+        since = since or {}
+        vv = {replica_id: counter for replica_id, counter in self.vv.items() if since.get(replica_id, 0) < counter}
+        items = {}
+        for replica_id in vv:
+            for item_name in self.replica_items.get(replica_id, ()):
+                entry = self.items[item_name][replica_id]
+                if entry[0] > since.get(replica_id, 0):
+                    items.setdefault(item_name, {})[replica_id] = entry
+        return {
+            "listID": self.listID,
+            "since": dict(since),
+            "vv": vv,
+            "items": items
+        }
 
-        return items.items()
+    def can_merge(self, other_list):
+        """A delta can only be merged by a list that has seen everything the delta was computed from."""
+        if not isinstance(other_list, dict) or "since" not in other_list:
+            return True
+        return all(self.vv.get(replica_id, 0) >= counter for replica_id, counter in other_list["since"].items())
 
     def merge(self, other_list):
-        """Merge this shopping list with another shopping list (other OR-Set)."""
+        """Merge this shopping list with another shopping list (other OR-Set) or a delta of one."""
+        if not self.can_merge(other_list):
+            return -1
         if isinstance(other_list, dict):
             other = ShoppingListORSet()
             other.deserialize(other_list)
         else:
             other = other_list
 
-        new_adds = {item for item in other.add_set if item[2] not in self.processed_tags}
-        new_removes = {item for item in other.remove_set if item[2] not in self.processed_tags}
+        # Only replicas the other list has seen further than this one can bring anything new
+        newer = [replica_id for replica_id, counter in other.vv.items() if self.vv.get(replica_id, 0) < counter]
 
-        self.processed_tags.update(tag for _, _, tag in new_adds | new_removes)
-
-        self.add_set |= new_adds
-        self.remove_set |= new_removes
+        # A replica only ever grows its own entries, so the one with the higher counter includes the other
+        for replica_id in newer:
+            for item_name in other.replica_items.get(replica_id, ()):
+                entry = other.items[item_name][replica_id]
+                current = self.items.get(item_name, {}).get(replica_id)
+                if current is None or current[0] < entry[0]:
+                    self._set_entry(item_name, replica_id, entry)
+            self.vv[replica_id] = other.vv[replica_id]
 
 
     def serialize(self):
         """Serialize the shopping list to a dictionary."""
         return {
             "listID": self.listID,
-            "add_set": list(self.add_set),
-            "remove_set": list(self.remove_set)
+            "vv": dict(self.vv),
+            "items": {item_name: dict(dots) for item_name, dots in self.items.items()}
         }
-    
+
     def deserialize(self, data):
         """Deserialize a dictionary to a shopping list."""
         self.listID = data["listID"]
-        # Add the items to the add set
-        self.add_set = set(tuple(item) for item in data["add_set"])
-        
-        # Add the items to the remove set
-        self.remove_set = set(tuple(item) for item in data["remove_set"])
+        if "add_set" in data:
+            self._deserialize_tags(data)
+            return
+        self.vv = dict(data["vv"])
+        self.items = {}
+        self.totals = {}
+        self.replica_items = {}
+        for item_name, dots in data["items"].items():
+            for replica_id, entry in dots.items():
+                self._set_entry(item_name, replica_id, tuple(entry))
+
+    def _deserialize_tags(self, data):
+        """Read the previous format of (item_name, quantity, tag) tuples.
+
+        Each tag becomes its own single-dot replica, so merging with replicas that still
+        hold the old format stays idempotent.
+        """
+        self.items = {}
+        self.vv = {}
+        self.totals = {}
+        self.replica_items = {}
+        for tuples, is_add in ((data["add_set"], True), (data["remove_set"], False)):
+            for item_name, quantity, tag in tuples:
+                replica_id = tag[:36].replace('-', '')
+                added, removed = (quantity, 0) if is_add else (0, quantity)
+                self._set_entry(item_name, replica_id, (1, added, removed))
+                self.vv[replica_id] = 1
 
     def __repr__(self):
         """Represent the current shopping list."""
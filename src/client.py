@@ -1,31 +1,155 @@
 import zmq
+import time
+import uuid
+import atexit
+import threading
 from ORSet import ShoppingListORSet
 from database import Database
+from ring import HashRing
+from peers import PeerPool
+
+SERVER_PORT = 6000  # Worker the client first talks to, and goes through when it cannot reach an owner
+TIMED_OUT = "Request timed out"
+REQUEST_TIMEOUT = 2.0  # Seconds to wait for the reply of a worker
+WRITE_BEHIND = 1.0  # Seconds between writes of the changed lists to the database
+HEDGE_READS = True  # Send a read to a second replica too when the first is slower than its p95
 
 class ShoppingListClient:
     def __init__(self, user):
         self.context = zmq.Context()
-        self.socket = self.context.socket(zmq.REQ)  # REQ socket to send requests to the server
-        self.socket.connect("tcp://127.0.0.1:6000")  # Connect to server on port 6000
-        self.socket.setsockopt(zmq.RCVTIMEO, 2000)  # Set timeout for receiving messages
+        # One DEALER socket per worker, kept across timeouts and shared with the sync engine
+        self.peers = PeerPool(self.context, REQUEST_TIMEOUT)
         self.db = Database(filename=f'database/{user}/shopping_lists.json')  # Initialize the database
+        self.replica_id = uuid.uuid4().hex[:8]  # Replica id of the dots this client creates
+        self.ring = HashRing()  # Cached view of the workers, to send requests straight to the owner of a list
+        self.replicas = 1  # Workers holding each list, any of them can serve a read
+        self.lists = {}  # list_id -> live ShoppingListORSet, read from the database once
+        self.synced = {}  # list_id -> server version vector the list was last synced with
+        self.unsaved = set()  # Lists changed in memory and not written to the database yet
+        self.dirty = None  # Lists with changes the server has not seen, computed on the first sync
+        self.lock = threading.RLock()  # Guards the lists against the write-behind and sync threads
+        threading.Thread(target=self.write_behind, daemon=True).start()
+        atexit.register(self.save)
+
+    def send_request(self, request, port=SERVER_PORT):
+        """Send a request to a worker (the server by default) and get the response."""
+        return self.request_worker({"id": str(port), "port": port}, request)
 
-    def send_request(self, request):
-        """Send a request to the server and get the response."""
+    def request_worker(self, worker, request):
         try:
-            self.socket.send_json(request)
-            response = self.socket.recv_json()
+            return self.peers.request(worker, request).result()
+        except (TimeoutError, ConnectionError):
+            return {"status": "error", "message": TIMED_OUT}
+
+    def refresh_ring(self):
+        """Fetch the members of the ring from the server."""
+        response = self.send_request({"action": "get_ring"})
+        if response.get("status") == "success":
+            self.ring = HashRing(response["workers"])
+            self.replicas = response.get("replicas", 1)
+
+    def send_to_owner(self, request):
+        """Send a request about a list straight to the worker owning it (any replica for a read), through the server if that fails."""
+        if not self.ring:
+            self.refresh_ring()
+        if request["action"] == "get_list":
+            response = self.send_to_replicas(request)
+        else:
+            # Writes go to the owner, or to the next replica while the ones before it do not answer
+            replicas = self.ring.preference_list(request["list_id"], self.replicas)
+            replicas.sort(key=lambda worker: not self.peers.healthy(worker["id"]))
+            response = {"status": "error", "message": TIMED_OUT}
+            for worker in replicas:
+                response = self.request_worker(worker, dict(request, direct=True))
+                if response.get("message") != TIMED_OUT:
+                    break
+        if response.get("status") != "not_owner" and response.get("message") != TIMED_OUT:
             return response
-        except zmq.error.Again:
-            self.socket.close()
-            self.socket = self.context.socket(zmq.REQ)
-            self.socket.connect("tcp://127.0.0.1:6000")
-            self.socket.setsockopt(zmq.RCVTIMEO, 2000)
-            return {"status": "error", "message": "Request timed out"}
+        self.refresh_ring()  # The ring changed since it was fetched
+        return self.send_request(request)
+
+    def send_to_replicas(self, request):
+        """Send a read to the replica answering fastest, hedged to a second one if it is slow."""
+        replicas = self.ring.preference_list(request["list_id"], self.replicas)
+        try:
+            return self.peers.hedged_request(replicas, dict(request, direct=True), HEDGE_READS).result()
+        except (TimeoutError, ConnectionError):
+            return {"status": "error", "message": TIMED_OUT}
     
+    def cached_list(self, list_id):
+        """The live shopping list, loaded from the database on first use, None if it is not stored locally."""
+        with self.lock:
+            if list_id not in self.lists:
+                found, record = self.db.lookup(list_id)
+                if not found:
+                    return None
+                shopping_list = ShoppingListORSet(listID=list_id, replica_id=self.replica_id)
+                shopping_list.deserialize(record)
+                self.lists[list_id] = shopping_list
+                self.synced[list_id] = record.get("synced_vv")
+            return self.lists[list_id]
+
+    def has_list(self, list_id):
+        return list_id in self.lists or list_id in self.db.get_lists()
+
+    def list_ids(self):
+        with self.lock:
+            cached = list(self.lists)
+        return cached + [list_id for list_id in self.db.get_lists() if list_id not in self.lists]
+
+    def store_list(self, shopping_list, synced_vv=None):
+        """Keep a changed shopping list (and the server version vector it was last synced with) until the next save."""
+        with self.lock:
+            list_id = shopping_list.listID
+            self.lists[list_id] = shopping_list
+            if synced_vv is not None:
+                self.synced[list_id] = synced_vv
+            else:
+                self.synced.setdefault(list_id, None)
+            self.unsaved.add(list_id)
+            if self.dirty is not None:
+                if self.is_dirty(list_id):
+                    self.dirty.add(list_id)
+                else:
+                    self.dirty.discard(list_id)
+
+    def synced_vv(self, list_id):
+        """Server version vector the stored list was last synced with, None if it was never synced."""
+        self.cached_list(list_id)
+        return self.synced.get(list_id)
+
+    def is_dirty(self, list_id):
+        """Whether the list has changes the server has not seen."""
+        synced_vv = self.synced_vv(list_id)
+        if synced_vv is None:
+            return True
+        return any(synced_vv.get(replica_id, 0) < counter for replica_id, counter in self.lists[list_id].vv.items())
+
+    def dirty_lists(self):
+        """Lists with changes the server has not seen, the stored lists are only checked the first time."""
+        with self.lock:
+            if self.dirty is None:
+                self.dirty = {list_id for list_id in self.list_ids() if self.is_dirty(list_id)}
+            return set(self.dirty)
+
+    def save(self):
+        """Write the lists changed in memory to the database."""
+        with self.lock:
+            for list_id in self.unsaved:
+                record = self.lists[list_id].serialize()
+                if self.synced.get(list_id) is not None:
+                    record["synced_vv"] = self.synced[list_id]
+                self.db.add_list(list_id, record)
+            self.unsaved = set()
+
+    def write_behind(self):
+        while True:
+            time.sleep(WRITE_BEHIND)
+            self.save()
+
     def create_list(self):
-        new_list = ShoppingListORSet()  # Create new shopping list
-        self.db.add_list(new_list.listID, new_list.serialize())  # Store the shopping list in the database
+        new_list = ShoppingListORSet(replica_id=self.replica_id)  # Create new shopping list
+        self.store_list(new_list)  # Keep it in memory, the write-behind thread saves it
         return new_list.listID
 
     def add_item(self, list_id, item_name, target_quantity):
@@ -36,8 +160,9 @@ class ShoppingListClient:
         if target_quantity <= 0:
           return (f"Quantity {target_quantity} is not valid")
         
-        shopping_list.add_item(item_name, target_quantity)
-        self.db.add_list(list_id, shopping_list.serialize())  # Update the shopping list in the database
+        with self.lock:
+            shopping_list.add_item(item_name, target_quantity)
+            self.store_list(shopping_list)  # Keep the change in memory, the write-behind thread saves it
         return (f"Item '{item_name}' added to list {list_id} with quantity {target_quantity}")
 
     def remove_item(self, list_id, item_name, quantity_acquired):
@@ -48,40 +173,100 @@ class ShoppingListClient:
         if quantity_acquired <= 0:
             return (f"Quantity {quantity_acquired} is not valid")
           
-        if (shopping_list.remove_item(item_name, quantity_acquired)) == -1:
-          return (f"Item {item_name} does not exist in list {list_id}")
-        
-        self.db.add_list(list_id, shopping_list.serialize())  # Update the shopping list in the database
+        with self.lock:
+            if (shopping_list.remove_item(item_name, quantity_acquired)) == -1:
+              return (f"Item {item_name} does not exist in list {list_id}")
+            self.store_list(shopping_list)  # Keep the change in memory, the write-behind thread saves it
         return (f"Item '{item_name}' removed from list {list_id} with quantity {quantity_acquired}")
 
     def get_list(self, list_id):
-        if list_id in list(self.db.get_lists()):
-            shopping_list = ShoppingListORSet(listID=list_id)
-            shopping_list.deserialize(self.db.get_list(list_id))
+        shopping_list = self.cached_list(list_id)
+        if shopping_list is not None:
             return shopping_list
         request = {
             "action": "get_list",
             "list_id": list_id
         }
-        response = self.send_request(request)
-        if response.get('status') is "error":
+        response = self.send_to_owner(request)
+        if response.get('status') == "error":
             return None
         if response.get('list') is None:
             return None
         
-        shopping_list = ShoppingListORSet(listID=list_id)
+        shopping_list = ShoppingListORSet(listID=list_id, replica_id=self.replica_id)
         shopping_list.deserialize(response["list"])
-        self.db.add_list(list_id, shopping_list.serialize())  # Update the shopping list in the database
+        self.store_list(shopping_list, response.get("vv"))  # Keep the change in memory, the write-behind thread saves it
         return shopping_list
+
+    def get_items(self, list_id):
+        """Snapshot of the items of a list, None if it does not exist.
+
+        Taken under the lock, the sync engine merges into the cached list from its own thread.
+        """
+        shopping_list = self.get_list(list_id)
+        if shopping_list is None:
+            return None
+        with self.lock:
+            return dict(shopping_list.get_list())
     
+    def get_many(self, list_ids):
+        """Get several lists, fetching the ones not stored locally in a single request."""
+        lists = {}
+        missing = {}
+        for list_id in list_ids:
+            if self.has_list(list_id):
+                lists[list_id] = self.get_list(list_id)
+            else:
+                missing[list_id] = {}
+        if missing:
+            results = self.send_request({"action": "get_many", "lists": missing}).get("results", {})
+            for list_id in missing:
+                result = results.get(list_id, {})
+                if result.get("status") != "success" or result.get("list") is None:
+                    lists[list_id] = None
+                    continue
+                shopping_list = ShoppingListORSet(listID=list_id, replica_id=self.replica_id)
+                shopping_list.deserialize(result["list"])
+                self.store_list(shopping_list, result.get("vv"))  # Keep the change in memory, the write-behind thread saves it
+                lists[list_id] = shopping_list
+        return lists
+
+    def pull_changes(self):
+        """Bring every stored list up to date with the server in a single request.
+
+        Returns the ids of the lists that changed, None if the server could not be reached.
+        """
+        lists = {}
+        requests = {}
+        for list_id in self.list_ids():
+            lists[list_id] = self.get_list(list_id)
+            with self.lock:
+                requests[list_id] = {"vv": dict(lists[list_id].vv)}
+        if not requests:
+            return []
+        response = self.send_request({"action": "get_many", "lists": requests})
+        if response.get("status") != "success":
+            return None
+        changed = []
+        for list_id, result in response["results"].items():
+            if result.get("status") == "success" and result.get("delta") is not None:
+                with self.lock:
+                    if result["delta"]["vv"]:
+                        lists[list_id].merge(result["delta"])
+                        changed.append(list_id)
+                    if result["delta"]["vv"] or result["vv"] != self.synced.get(list_id):
+                        self.store_list(lists[list_id], result["vv"])  # Keep the change in memory, the write-behind thread saves it
+        return changed
+
     def get_lists(self):
-        if not self.db.get_lists():
+        if not self.lists and not self.db.get_lists():
             return {"status": "error", "message": "No lists found"}
-        lists = self.db.get_lists()
+        # Local lists only, the sync engine pulls the remote changes in the background
+        lists = {list_id: self.cached_list(list_id) for list_id in self.list_ids()}
         result = {}
-        for list_id in lists:
-            shopping_list = self.get_list(list_id)
-            items = dict(shopping_list.get_list())
+        for list_id, shopping_list in lists.items():
+            with self.lock:
+                items = dict(shopping_list.get_list())
             result[list_id] = items
             print(f"List ID: {list_id}")
             for item_name, quantity in items.items():
@@ -89,18 +274,62 @@ class ShoppingListClient:
         return result
 
     def merge_lists(self, list_id):
-        if list_id not in self.db.get_lists():
+        shopping_list = self.cached_list(list_id)
+        if shopping_list is None:
             return {"status": "error", "message": f"List {list_id} does not exist"}
 
         request = {
             "action": "merge_lists",
-            "list_id": list_id,
-            "list": self.db.get_list(list_id)
+            "list_id": list_id
         }
-        response = self.send_request(request)
-        if response.get('status') is "error":
+        with self.lock:
+            request.update(self.merge_request(shopping_list, self.synced_vv(list_id)))
+        response = self.send_to_owner(request)
+        if response.get('status') == "resync":
+            del request["delta"]
+            with self.lock:
+                request.update(self.merge_request(shopping_list, None))
+            response = self.send_to_owner(request)
+        if response.get('status') == "error":
             return response
-        self.db.add_list(list_id, response["list"])  # Update the shopping list in the database
-        shopping_list = ShoppingListORSet(listID=list_id)
-        shopping_list.deserialize(response["list"])
+        with self.lock:
+            shopping_list.merge(response["delta"])
+            self.store_list(shopping_list, response["vv"])  # Keep the change in memory, the write-behind thread saves it
+        return response
+
+    def merge_request(self, shopping_list, synced_vv):
+        """Fields of a merge: send only what the server has not seen, and ask only for what we have not seen."""
+        request = {"vv": dict(shopping_list.vv)}
+        if synced_vv is None:
+            request["list"] = shopping_list.serialize()
+        else:
+            request["delta"] = shopping_list.delta(synced_vv)
+        return request
+
+    def sync_all(self):
+        """Sync every list with changes the server has not seen, in a single request."""
+        lists = {}
+        requests = {}
+        for list_id in self.dirty_lists():
+            lists[list_id] = self.cached_list(list_id)
+            with self.lock:
+                requests[list_id] = self.merge_request(lists[list_id], self.synced_vv(list_id))
+        if not requests:
+            return {"status": "success", "results": {}}
+
+        response = self.send_request({"action": "merge_many", "lists": requests})
+        if response.get('status') != "success":
+            return response
+        results = response["results"]
+        with self.lock:
+            resync = {list_id: self.merge_request(lists[list_id], None) for list_id, result in results.items() if result.get('status') == "resync"}
+        if resync:
+            retried = self.send_request({"action": "merge_many", "lists": resync})
+            results.update(retried.get("results", {}))
+
+        for list_id, result in results.items():
+            if result.get('status') == "success":
+                with self.lock:
+                    lists[list_id].merge(result["delta"])
+                    self.store_list(lists[list_id], result["vv"])  # Keep the change in memory, the write-behind thread saves it
         return response
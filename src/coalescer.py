@@ -0,0 +1,80 @@
+import time
+import threading
+from concurrent.futures import Future
+
+FLUSH_WINDOW = 0.02  # Seconds a write may wait for other writes to the same list
+FLUSH_MAX_PENDING = 64  # Pending writes that force a flush before the window ends
+
+class WriteCoalescer:
+    """Group commit for the worker: writes to the same list are persisted and replicated once per flush.
+
+    Every submitted write gets a Future that resolves once the list it touched has been
+    persisted, with whatever the replicate callback returned for the list (the Futures of
+    its replica pushes). The callback must not block, a flush never waits for replicas.
+    All the lists of a flush are written and synced to disk together, one fsync per group.
+    """
+
+    def __init__(self, persist, replicate, window=FLUSH_WINDOW, max_pending=FLUSH_MAX_PENDING):
+        self.persist = persist  # Callback that writes and syncs a group of lists to the database
+        self.replicate = replicate  # Callback that queues one list for the replicas
+        self.window = window
+        self.max_pending = max_pending
+        self.pending = {}  # list_id -> [replicate, futures]
+        self.pending_ops = 0
+        self.deadline = None
+        self.condition = threading.Condition()
+        self.flushes = 0  # Number of list writes actually done
+        self.ops = 0  # Number of writes submitted
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, list_id, replicate=True):
+        """Mark a list as changed in memory, return a Future resolved once it is persisted."""
+        future = Future()
+        with self.condition:
+            entry = self.pending.setdefault(list_id, [False, []])
+            entry[0] = entry[0] or replicate
+            entry[1].append(future)
+            self.pending_ops += 1
+            self.ops += 1
+            if self.deadline is None:
+                self.deadline = time.time() + self.window
+            self.condition.notify()
+        return future
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                while self.pending_ops < self.max_pending:
+                    remaining = self.deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                batch = self.pending
+                self.pending = {}
+                self.pending_ops = 0
+                self.deadline = None
+            self.flush(batch)
+
+    def flush(self, batch):
+        replicated = {}
+        for list_id, (replicate, futures) in batch.items():
+            replicated[list_id] = []
+            if replicate:
+                # Queued first, so the replicas get the write while it is persisted here
+                try:
+                    replicated[list_id] = self.replicate(list_id)
+                except Exception as error:
+                    print(f"Replication of list {list_id[:6]} failed: {error}")
+        try:
+            self.persist(list(batch))
+            self.flushes += len(batch)
+        except Exception as error:
+            for _, futures in batch.values():
+                for future in futures:
+                    future.set_exception(error)
+            return
+        for list_id, (_, futures) in batch.items():
+            for future in futures:
+                future.set_result(replicated[list_id])
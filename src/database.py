@@ -1,36 +1,400 @@
 import json
 import os
+import heapq
+import zlib
+import struct
+import sqlite3
+import threading
+from codec import encode, decode, STORAGE_CODEC
+from merkle import MerkleIndex, state_hash, leaf_of, to_int, HASH_BYTES, HASH_VERSION
+
+COMPACT_THRESHOLD = 1000  # Number of log records before the tail is compacted into the index
+SCAN_PAGE = 1000  # Number of keys fetched from the index per query when iterating
+SEGMENT_MAGIC = b'SLOG\x01'  # Start of a segment of framed records, older segments are JSON lines
+RECORD_HEADER = struct.Struct('<II')  # Length and CRC32 of each record in a log segment
+
+class ListIds:
+    """Lazy view over the list ids in the database, no list is decoded to iterate it."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __iter__(self):
+        return self.db.iter_list_ids()
+
+    def __contains__(self, list_id):
+        return self.db.has_list(list_id)
+
+    def __len__(self):
+        return self.db.count_lists()
+
+    def __bool__(self):
+        return next(iter(self), None) is not None
 
 class Database:
-    def __init__(self, filename='database/shopping_lists.json'):
-        self.filename = filename
-        self.data = {}
+    """Log-structured store: an indexed SQLite snapshot plus the log segments written since it.
+
+    Only the log tail is kept in memory, lists in the snapshot are fetched and decoded on demand.
+    """
+
+    def __init__(self, filename='database/shopping_lists.json', compact_threshold=COMPACT_THRESHOLD, codec=None, merkle=False):
+        self.filename = filename  # Legacy JSON snapshot, also the prefix of the log segments
+        self.index_filename = os.path.splitext(filename)[0] + '.db'
+        self.compact_threshold = compact_threshold
+        self.codec = codec or STORAGE_CODEC  # Codec of new records
+        self.tail = {}  # Records not compacted yet: list_id -> list (None if deleted)
+        self.compacting = {}  # Tail being written to the index by the compactor
+        self.lock = threading.Lock()
+        self.index_lock = threading.Lock()
+        self.index = None
+        self.segment = 0  # Sequence number of the segment currently being appended to
+        self.log = None
+        self.log_records = 0
+        self.compactor = None
+        self.hashing = merkle  # Whether compactions keep the hashes of the lists, only stores comparing trees pay for them
+        self.unhashed = False  # Whether the index has lists without a hash
         self.load()
+        self.merkle = None  # Hashes of the lists for anti-entropy, only used if asked for
+        if merkle:
+            self.merkle = MerkleIndex(self)
+            if self.unhashed:
+                threading.Thread(target=self.hash_index, daemon=True).start()
+
+    def segment_path(self, segment):
+        return f"{self.filename}.{segment}.log"
+
+    def segments(self):
+        """Sequence numbers of the log segments on disk, oldest first."""
+        directory = os.path.dirname(self.filename) or '.'
+        prefix = os.path.basename(self.filename) + '.'
+        segments = []
+        for name in os.listdir(directory):
+            if name.startswith(prefix) and name.endswith('.log'):
+                segment = name[len(prefix):-len('.log')]
+                if segment.isdigit():
+                    segments.append(int(segment))
+        return sorted(segments)
 
     def load(self):
-        if os.path.exists(self.filename):
-            with open(self.filename, 'r') as file:
-                self.data = json.load(file)
-        else:
-            self.data = {}
-            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
-            with open(self.filename, 'w') as file:
-                json.dump({}, file)
+        """Open the index and replay the log segments that were not compacted yet."""
+        os.makedirs(os.path.dirname(self.filename) or '.', exist_ok=True)
+        self.index = sqlite3.connect(self.index_filename, check_same_thread=False)
+        self.index.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        # Hash of every list and XOR of the hashes in each leaf, for anti-entropy
+        self.index.execute("CREATE TABLE IF NOT EXISTS leaves (leaf INTEGER PRIMARY KEY, digest BLOB NOT NULL)")
+        columns = [row[1] for row in self.index.execute("PRAGMA table_info(lists)")]
+        if not columns:
+            self.index.execute("CREATE TABLE lists (list_id TEXT PRIMARY KEY, data BLOB NOT NULL, hash BLOB)")
+            if not self.hashing:
+                self.index.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('unhashed', 1)")
+        elif "hash" not in columns:
+            self.index.execute("ALTER TABLE lists ADD COLUMN hash BLOB")
+            self.index.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('unhashed', 1)")
+        row = self.index.execute("SELECT value FROM meta WHERE key = 'hash_version'").fetchone()
+        if row is None or row[0] != HASH_VERSION:
+            if columns and "hash" in columns:
+                # Hashed another way, every list is hashed again in the background
+                self.index.execute("UPDATE lists SET hash = NULL")
+                self.index.execute("DELETE FROM leaves")
+                self.index.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('unhashed', 1)")
+            self.index.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('hash_version', ?)", (HASH_VERSION,))
+        self.index.commit()
+        self.unhashed = self.index.execute("SELECT 1 FROM meta WHERE key = 'unhashed'").fetchone() is not None
+        self.migrate()
+
+        row = self.index.execute("SELECT value FROM meta WHERE key = 'compacted_segment'").fetchone()
+        compacted_segment = row[0] if row else 0
+
+        segments = self.segments()
+        for segment in segments:
+            if segment <= compacted_segment:
+                os.remove(self.segment_path(segment))  # Already in the index
+            else:
+                self.replay(segment)
+
+        # Always start a fresh segment, so a torn record at the end of the last one is never appended to
+        self.segment = max(segments + [compacted_segment]) + 1
+        self.open_segment()
+
+    def migrate(self):
+        """Import a JSON snapshot written by older versions into the index."""
+        if not os.path.exists(self.filename):
+            return
+        with open(self.filename, 'r') as file:
+            data = json.load(file)
+        with self.index:
+            self.store(data)
+        os.remove(self.filename)
+
+    def replay(self, segment):
+        with open(self.segment_path(segment), 'rb') as file:
+            data = file.read()
+        if not data.startswith(SEGMENT_MAGIC):
+            self.replay_lines(data)
+            return
+        position = len(SEGMENT_MAGIC)
+        while position + RECORD_HEADER.size <= len(data):
+            length, checksum = RECORD_HEADER.unpack_from(data, position)
+            payload = data[position + RECORD_HEADER.size:position + RECORD_HEADER.size + length]
+            if len(payload) < length or zlib.crc32(payload) != checksum:
+                break  # Torn write at the end of the segment
+            self.apply(decode(payload))
+            self.log_records += 1
+            position += RECORD_HEADER.size + length
+
+    def replay_lines(self, data):
+        """Replay a segment written as JSON lines by older versions."""
+        for line in data.splitlines():
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                break  # Torn write at the end of the segment
+            self.apply(record)
+            self.log_records += 1
+
+    def open_segment(self):
+        self.log = open(self.segment_path(self.segment), 'ab')
+        self.log.write(SEGMENT_MAGIC)
+
+    def apply(self, record):
+        if record["op"] == "put":
+            self.tail[record["id"]] = record["list"]
+        elif record["op"] == "del":
+            self.tail[record["id"]] = None
+
+    def append(self, record):
+        """Append one record to the current segment and apply it to the tail."""
+        self.append_many([record])
+
+    def append_many(self, records, sync=False):
+        """Append records to the current segment with a single write, and fsync it once if asked to."""
+        frames = bytearray()
+        for record in records:
+            payload = encode(record, self.codec)
+            frames += RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        with self.lock:
+            self.log.write(frames)
+            self.log.flush()
+            # Synced through its own descriptor, so the tail is not locked during the fsync
+            log = os.dup(self.log.fileno()) if sync else None
+            for record in records:
+                self.apply(record)
+            self.log_records += len(records)
+            if self.log_records >= self.compact_threshold and self.compactor is None:
+                self.rotate()
+        if log is not None:
+            try:
+                os.fsync(log)
+            finally:
+                os.close(log)
+
+    def rotate(self):
+        """Switch to a new segment and compact the tail into the index in the background."""
+        self.compacting = self.tail
+        self.tail = {}
+        last_segment = self.segment
+        self.log.close()
+        self.segment += 1
+        self.open_segment()
+        self.log_records = 0
+        self.compactor = threading.Thread(target=self.compact, args=(self.compacting, last_segment), daemon=True)
+        self.compactor.start()
+
+    def compact(self, records, last_segment):
+        """Write the records of the covered segments to the index and drop those segments."""
+        try:
+            with self.index_lock, self.index:
+                self.store(records)
+                self.index.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES ('compacted_segment', ?)", (last_segment,)
+                )
+            for segment in self.segments():
+                if segment <= last_segment:
+                    os.remove(self.segment_path(segment))
+        finally:
+            with self.lock:
+                self.compacting = {}
+                self.compactor = None
+
+    def store(self, records):
+        """Write some lists (None to delete one) to the index with their hashes, and update the digests of their leaves."""
+        if not self.hashing:
+            self.store_unhashed(records)
+            return
+        changes = []  # (list id, old hash, new hash)
+        for list_id, items in records.items():
+            row = self.index.execute("SELECT hash FROM lists WHERE list_id = ?", (list_id,)).fetchone()
+            old = to_int(row[0]) if row else 0
+            if items is None:
+                self.index.execute("DELETE FROM lists WHERE list_id = ?", (list_id,))
+                changes.append((list_id, old, 0))
+            else:
+                new = state_hash(list_id, items)
+                self.index.execute(
+                    "INSERT OR REPLACE INTO lists (list_id, data, hash) VALUES (?, ?, ?)",
+                    (list_id, encode(items, self.codec), new.to_bytes(HASH_BYTES, 'big'))
+                )
+                changes.append((list_id, old, new))
+        self.update_leaves(changes)
+
+    def store_unhashed(self, records):
+        """Write some lists (None to delete one) to the index without hashing them."""
+        if not self.unhashed:
+            # The leaves would go stale, drop the hashes and let a store comparing trees rebuild them
+            self.index.execute("UPDATE lists SET hash = NULL")
+            self.index.execute("DELETE FROM leaves")
+            self.index.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('unhashed', 1)")
+            self.unhashed = True
+        self.index.executemany(
+            "INSERT OR REPLACE INTO lists (list_id, data, hash) VALUES (?, ?, NULL)",
+            ((list_id, encode(items, self.codec)) for list_id, items in records.items() if items is not None)
+        )
+        self.index.executemany(
+            "DELETE FROM lists WHERE list_id = ?",
+            ((list_id,) for list_id, items in records.items() if items is None)
+        )
+
+    def update_leaves(self, changes):
+        """XOR the old and new hashes of some lists into the digests of their leaves."""
+        deltas = {}
+        for list_id, old, new in changes:
+            leaf = leaf_of(list_id)
+            deltas[leaf] = deltas.get(leaf, 0) ^ old ^ new
+        for leaf, delta in deltas.items():
+            if not delta:
+                continue
+            row = self.index.execute("SELECT digest FROM leaves WHERE leaf = ?", (leaf,)).fetchone()
+            digest = (to_int(row[0]) if row else 0) ^ delta
+            self.index.execute("INSERT OR REPLACE INTO leaves (leaf, digest) VALUES (?, ?)", (leaf, digest.to_bytes(HASH_BYTES, 'big')))
+
+    def hash_index(self):
+        """Hash the lists stored before the index kept hashes, a page at a time, in the background."""
+        bound = ""
+        while True:
+            with self.index_lock:
+                rows = self.index.execute(
+                    "SELECT list_id, data FROM lists WHERE list_id >= ? AND hash IS NULL ORDER BY list_id LIMIT ?", (bound, SCAN_PAGE)
+                ).fetchall()
+            hashes = [(list_id, state_hash(list_id, decode(data))) for list_id, data in rows]
+            with self.index_lock, self.index:
+                changes = []
+                for list_id, new in hashes:
+                    # A compaction may have written the list again meanwhile, with its hash
+                    updated = self.index.execute(
+                        "UPDATE lists SET hash = ? WHERE list_id = ? AND hash IS NULL", (new.to_bytes(HASH_BYTES, 'big'), list_id)
+                    )
+                    if updated.rowcount:
+                        changes.append((list_id, 0, new))
+                self.update_leaves(changes)
+                if len(rows) < SCAN_PAGE:
+                    self.index.execute("DELETE FROM meta WHERE key = 'unhashed'")
+            if len(rows) < SCAN_PAGE:
+                break
+            bound = rows[-1][0] + '\x00'  # Smallest id after the last one
+        self.unhashed = False
+
     def save(self):
-        with open(self.filename, 'w') as file:
-            json.dump(self.data, file, indent=4)
+        """Force the whole tail into the index."""
+        while True:
+            with self.lock:
+                running = self.compactor
+                if running is None:
+                    self.rotate()
+                    compactor = self.compactor
+                    break
+            running.join()  # Wait for the running compaction, it does not cover the latest records
+        compactor.join()
+
+    def close(self):
+        with self.lock:
+            compactor = self.compactor
+        if compactor is not None:
+            compactor.join()
+        with self.lock:
+            self.log.close()
+        with self.index_lock:
+            self.index.close()
+
+    def lookup(self, list_id):
+        """Return (found, list) for a list id, checking the tail before the index."""
+        with self.lock:
+            for records in (self.tail, self.compacting):
+                if list_id in records:
+                    return records[list_id] is not None, records[list_id]
+        with self.index_lock:
+            row = self.index.execute("SELECT data FROM lists WHERE list_id = ?", (list_id,)).fetchone()
+        if row is None:
+            return False, None
+        return True, decode(row[0])
+
+    def pending_lists(self):
+        """Lists written since the last compaction (None if deleted)."""
+        with self.lock:
+            pending = dict(self.compacting)
+            pending.update(self.tail)
+        return pending
+
+    def iter_list_ids(self, start="", end=None):
+        """Ids of the stored lists in order, only those in [start, end) if a range is given."""
+        pending = self.pending_lists()
+        live = sorted(
+            list_id for list_id, items in pending.items()
+            if items is not None and list_id >= start and (end is None or list_id < end)
+        )
+        return heapq.merge(self.scan_index(start, end, pending), live)
+
+    def scan_index(self, start, end, pending):
+        """Ids in the index within [start, end), a page at a time, skipping the ones in the tail."""
+        query = "SELECT list_id FROM lists WHERE list_id >= ?" if end is None else \
+            "SELECT list_id FROM lists WHERE list_id >= ? AND list_id < ?"
+        bound = start
+        while True:
+            with self.index_lock:
+                rows = self.index.execute(
+                    query + " ORDER BY list_id LIMIT ?", (bound, SCAN_PAGE) if end is None else (bound, end, SCAN_PAGE)
+                ).fetchall()
+            for (list_id,) in rows:
+                if list_id not in pending:
+                    yield list_id
+            if len(rows) < SCAN_PAGE:
+                break
+            bound = rows[-1][0] + '\x00'  # Smallest id after the last one
+
+    def count_lists(self):
+        pending = self.pending_lists()
+        with self.index_lock:
+            count = self.index.execute("SELECT COUNT(*) FROM lists").fetchone()[0]
+            for list_id, items in pending.items():
+                indexed = self.index.execute("SELECT 1 FROM lists WHERE list_id = ?", (list_id,)).fetchone()
+                if indexed and items is None:
+                    count -= 1
+                elif not indexed and items is not None:
+                    count += 1
+        return count
+
+    def has_list(self, list_id):
+        with self.lock:
+            for records in (self.tail, self.compacting):
+                if list_id in records:
+                    return records[list_id] is not None
+        with self.index_lock:
+            return self.index.execute("SELECT 1 FROM lists WHERE list_id = ?", (list_id,)).fetchone() is not None
 
     def add_list(self, list_id, items):
-        self.data[list_id] = items
-        self.save()
+        """Store a list, it survives a crash of the process but not yet a power loss."""
+        self.append({"op": "put", "id": list_id, "list": items})
+
+    def add_lists(self, lists):
+        """Store several lists with one write and one fsync, they survive a power loss once it returns."""
+        self.append_many([{"op": "put", "id": list_id, "list": items} for list_id, items in lists.items()], sync=True)
 
     def get_lists(self):
-        return self.data.keys()
+        return ListIds(self)
 
     def get_list(self, list_id):
-        return self.data.get(list_id, [])
+        found, items = self.lookup(list_id)
+        return items if found else []
 
     def delete_list(self, list_id):
-        if list_id in self.data:
-            del self.data[list_id]
-            self.save()
\ No newline at end of file
+        if self.has_list(list_id):
+            self.append({"op": "del", "id": list_id})
@@ -0,0 +1,123 @@
+import zlib
+import zmq
+import itertools
+from codec import encode, decode, peek_str
+
+PROCESSES = 1  # Shard processes behind the port of a worker, one per core to use
+SPLIT = b"split"  # First envelope frame of the parts of a split batch, client identities start with a zero byte
+
+def shard_of(list_id, shards):
+    """Shard owning a list: list ids are hashes, so their first 32 bits split the key range evenly."""
+    try:
+        return int(list_id[:8], 16) * shards >> 32
+    except (TypeError, ValueError):
+        return zlib.crc32(str(list_id).encode('utf-8')) % shards
+
+def shard_span(shard, shards):
+    """Key range [start, end) of a shard, end None for the last one."""
+    bound = lambda shard: format(-((-shard << 32) // shards), "08x")  # First 32-bit prefix of the shard
+    return ("" if shard == 0 else bound(shard), None if shard == shards - 1 else bound(shard + 1))
+
+def shard_address(port, shard):
+    """Address a shard process binds to, inside its own database directory."""
+    return f"ipc://database/worker{port}/shard{shard}/worker.ipc"
+
+class Dispatcher:
+    """Front end of a worker running as several processes.
+
+    Binds the advertised port and relays every request, envelope included, to the shard process
+    owning its list over ipc://. The shards reply with the envelope untouched, so relaying the
+    replies back needs no bookkeeping. The list id is read without decoding the payload when possible.
+    Batches spanning several shards (merge_many, get_many, handoff_batch) are split per shard,
+    and the replies of the parts are combined into one.
+    """
+
+    def __init__(self, port, shards):
+        self.port = port
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.ROUTER)
+        self.socket.bind(f"tcp://*:{port}")
+        self.shards = []
+        for shard in range(shards):
+            connection = self.context.socket(zmq.DEALER)
+            connection.connect(shard_address(port, shard))
+            self.shards.append(connection)
+
+        self.splits = {}  # split id -> [envelope, parts left, replies of the parts]
+        self.split_ids = itertools.count()
+
+        self.poller = zmq.Poller()
+        self.poller.register(self.socket, zmq.POLLIN)
+        for connection in self.shards:
+            self.poller.register(connection, zmq.POLLIN)
+
+    def route(self, frames):
+        payload = frames[-1]
+        list_id = peek_str(payload, "list_id")
+        if list_id is None:
+            try:
+                request = decode(payload)
+            except Exception:
+                request = {}
+            list_id = request.get("list_id")
+            if list_id is None and isinstance(request.get("lists"), dict) and len(self.shards) > 1:
+                return self.split(frames[:-1], request)
+        if list_id is None:
+            shard = 0  # Requests without a list, like stats
+        else:
+            shard = shard_of(list_id, len(self.shards))
+        self.shards[shard].send_multipart(frames)
+
+    def split(self, envelope, request):
+        """Send each shard the part of a batch it owns."""
+        parts = {}
+        for list_id, list_request in request["lists"].items():
+            parts.setdefault(shard_of(list_id, len(self.shards)), {})[list_id] = list_request
+        if len(parts) <= 1:
+            shard = next(iter(parts), 0)
+            self.shards[shard].send_multipart(envelope + [encode(request)])
+            return
+        split_id = str(next(self.split_ids)).encode()
+        self.splits[split_id] = [envelope, len(parts), []]
+        for shard, lists in parts.items():
+            self.shards[shard].send_multipart([SPLIT, split_id, b''] + [encode(dict(request, lists=lists))])
+
+    def collect(self, frames):
+        """Keep the reply of a part, send the combined reply once every part answered."""
+        split = self.splits[frames[1]]
+        split[1] -= 1
+        split[2].append(decode(frames[-1]))
+        if split[1] == 0:
+            del self.splits[frames[1]]
+            self.socket.send_multipart(split[0] + [encode(combine(split[2]))])
+
+    def start(self):
+        while True:
+            socks = dict(self.poller.poll())
+            if self.socket in socks:
+                self.route(self.socket.recv_multipart())
+            for connection in self.shards:
+                if connection in socks:
+                    frames = connection.recv_multipart()
+                    if frames[0] == SPLIT:
+                        self.collect(frames)
+                    else:
+                        self.socket.send_multipart(frames)
+
+def combine(replies):
+    """One reply out of the replies to the parts of a batch: results merged, counts added, the first failure kept."""
+    combined = {"status": "success"}
+    for reply in replies:
+        for key, value in reply.items():
+            if key == "status" or key == "message":
+                continue
+            if isinstance(value, dict):
+                combined.setdefault(key, {}).update(value)
+            elif isinstance(value, int) and not isinstance(value, bool):
+                combined[key] = combined.get(key, 0) + value
+            else:
+                combined.setdefault(key, value)
+        if reply.get("status") != "success" and combined["status"] == "success":
+            combined["status"] = reply.get("status")
+            combined["message"] = reply.get("message")
+    return combined
@@ -1,10 +1,15 @@
 import sys
+import queue
 from client import ShoppingListClient
+from syncer import SyncEngine
 
 class ShoppingListCLI:
     def __init__(self, user="alice"):
         self.user = user
         self.client = ShoppingListClient(user)
+        self.notifications = queue.Queue()  # Sync events, shown before the next prompt
+        self.sync = SyncEngine(self.client, notify=self.notifications.put)
+        self.sync.start()
 
     def create_list(self):
         message = self.client.create_list()
@@ -12,19 +17,21 @@ class ShoppingListCLI:
 
     def add_item(self, list_id, item_name, quantity):
         message = self.client.add_item(list_id, item_name, quantity)
+        self.sync.sync_now()
         return message
         
     def remove_item(self, list_id, item_name, quantity):
         message = self.client.remove_item(list_id, item_name, quantity)
+        self.sync.sync_now()
         return message
 
     def get_items(self, list_id):
-        shopping_list = self.client.get_list(list_id)
-        if shopping_list is None:
+        items = self.client.get_items(list_id)
+        if items is None:
           return (f"List {list_id} does not exist") 
-        if shopping_list and shopping_list.get_list():
+        if items:
             message = f"Items in list {list_id}:"
-            for item_name, quantity in shopping_list.get_list():
+            for item_name, quantity in items.items():
                 message += f"\n - {item_name}: {quantity}"
         else:
             message = f"No items found in list {list_id}"
@@ -48,6 +55,23 @@ class ShoppingListCLI:
 
         return message
 
+    def sync_all(self):
+        response = self.client.sync_all()
+
+        if response.get('status') != 'success':
+            return f"Error syncing lists to server: '{response.get('message')}'"
+        results = response['results']
+        synced = sum(result.get('status') == 'success' for result in results.values())
+        return f"{synced} of {len(results)} changed lists synced to the server"
+
+    def show_notifications(self):
+        while not self.notifications.empty():
+            event = self.notifications.get()
+            if event["event"] == "synced":
+                print(f"\n** [sync] {len(event['pushed'])} lists pushed, {len(event['pulled'])} lists updated from the server **")
+            elif event["event"] == "offline":
+                print(f"\n** [sync] Server unreachable, retrying in {event['retry_in']:.0f}s **")
+
     def welcome(self):
         print("************************")
         print(f"** Hi, {self.user}! Welcome to the Shopping List CLI!")
@@ -61,7 +85,8 @@ class ShoppingListCLI:
 
     def run(self):
         while True:
-            command = input("\nEnter command (create, add, get, get_lists, remove, sync, quit): ").strip().lower()
+            self.show_notifications()
+            command = input("\nEnter command (create, add, get, get_lists, remove, sync, sync_all, quit): ").strip().lower()
             if command == "create":
                 message = self.create_list()
                 print("\n*************************************************")
@@ -133,6 +158,9 @@ class ShoppingListCLI:
                     continue
                 message = self.sync_list(list_id)
                 print(message)
+            elif command == "sync_all":
+                message = self.sync_all()
+                print(message)
             elif command == "quit":
                 break
             else:
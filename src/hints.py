@@ -0,0 +1,49 @@
+import time
+import itertools
+import threading
+from database import Database
+
+class HintStore:
+    """Durable queue of the lists a replica missed while it was unreachable, keyed by target worker.
+
+    A hint only names the list: the latest local state is what gets replayed, so any number of
+    missed writes to a list make a single hint. Hints live in their own log-structured database
+    under "<target id>:<list id>", so the hints of a target are a range scan.
+    """
+
+    def __init__(self, filename):
+        self.db = Database(filename=filename)
+        # Tells a hint written again during a replay from the one replayed, across restarts too
+        self.seq = itertools.count(int(time.time() * 1000000))
+        self.lock = threading.Lock()
+
+    def add(self, target, list_id):
+        with self.lock:
+            self.db.add_list(f"{target['id']}:{list_id}", {"port": target["port"], "seq": next(self.seq)})
+
+    def targets(self):
+        """Ids of the workers with hints waiting."""
+        targets = []
+        for key in self.db.iter_list_ids():
+            target_id = key.split(":", 1)[0]
+            if not targets or targets[-1] != target_id:
+                targets.append(target_id)
+        return targets
+
+    def pending(self, target_id):
+        """(list id, sequence) of the hints waiting for a worker."""
+        hints = []
+        for key in self.db.iter_list_ids(target_id + ":", target_id + ";"):
+            hint = self.db.get_list(key)
+            if hint:
+                hints.append((key.split(":", 1)[1], hint["seq"]))
+        return hints
+
+    def remove(self, target_id, hints):
+        """Drop replayed hints, unless the list missed another write since."""
+        with self.lock:
+            for list_id, seq in hints:
+                key = f"{target_id}:{list_id}"
+                hint = self.db.get_list(key)
+                if hint and hint["seq"] == seq:
+                    self.db.delete_list(key)
@@ -0,0 +1,128 @@
+import json
+import bisect
+import hashlib
+
+LEAF_DIGITS = 4  # Hex digits of a list id picking its leaf
+LEAVES = 16 ** LEAF_DIGITS
+BOUNDS = [format(leaf, f'0{LEAF_DIGITS}x') for leaf in range(LEAVES)]  # Smallest key of each leaf
+HASH_BYTES = 16
+HASH_VERSION = 2  # Bumped whenever state_hash changes, indexes hashed by another version are hashed again
+
+def state_hash(list_id, record):
+    """Hash of a stored list: its version vector, every add and remove bumps it, so equal vectors mean equal lists.
+
+    The state is hashed as canonical JSON, never with the codec of the worker, so workers using
+    different codecs agree on the hash of the same list.
+    """
+    if "vv" in record:
+        state = json.dumps(sorted(record["vv"].items()), separators=(',', ':'))
+    else:
+        state = json.dumps(record, sort_keys=True, separators=(',', ':'))
+    return int.from_bytes(hashlib.blake2b((list_id + state).encode('utf-8'), digest_size=HASH_BYTES).digest(), 'big')
+
+def leaf_of(key):
+    """Leaf holding a list id (or a range bound), the leaves split the keys in order."""
+    return max(bisect.bisect_right(BOUNDS, key) - 1, 0)
+
+def in_range(list_id, start, end):
+    return list_id >= start and (end is None or list_id < end)
+
+def to_int(digest):
+    return int.from_bytes(digest, 'big') if digest else 0
+
+class MerkleIndex:
+    """Hashes of the stored lists for anti-entropy, bucketed by id prefix.
+
+    The index of the database keeps the hash of every compacted list and the digest of every
+    leaf (the XOR of the hashes of its lists), both updated by each compaction, so opening a
+    store decodes nothing. The digest of a key range is the XOR of the leaves it covers plus the
+    matching lists of the two leaves it cuts, corrected for the lists still in the log tail.
+    Trees over ranges are built from these digests on demand.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    @property
+    def ready(self):
+        """False while lists stored before the hashes existed are being hashed."""
+        return not self.db.unhashed
+
+    def indexed_hashes(self, start, end):
+        """Hash of every list of the index in [start, end), the index lock must be held."""
+        if end is None:
+            rows = self.db.index.execute("SELECT list_id, hash FROM lists WHERE list_id >= ? AND hash IS NOT NULL", (start,))
+        else:
+            rows = self.db.index.execute("SELECT list_id, hash FROM lists WHERE list_id >= ? AND list_id < ? AND hash IS NOT NULL", (start, end))
+        return {list_id: to_int(digest) for list_id, digest in rows}
+
+    def pending(self):
+        """Sorted ids and hashes (0 if deleted) of the lists in the log tail, with the hashes the index still has for them."""
+        pending = self.db.pending_lists()
+        hashes = {list_id: 0 if record is None else state_hash(list_id, record) for list_id, record in pending.items()}
+        ids = sorted(hashes)
+        indexed = {}
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            rows = self.db.index.execute(
+                f"SELECT list_id, hash FROM lists WHERE list_id IN ({','.join('?' * len(chunk))})", chunk
+            )
+            indexed.update((list_id, to_int(digest)) for list_id, digest in rows)
+        return ids, hashes, indexed
+
+    def digests(self, ranges):
+        """Digest of the lists in each [start, end) range."""
+        digests = []
+        with self.db.index_lock:
+            ids, hashes, indexed = self.pending()
+            leaves = {leaf: to_int(digest) for leaf, digest in self.db.index.execute("SELECT leaf, digest FROM leaves")}
+            for start, end in ranges:
+                first, last = leaf_of(start), LEAVES - 1 if end is None else leaf_of(end)
+                digest = 0
+                for leaf in range(first + 1, last):
+                    digest ^= leaves.get(leaf, 0)
+                if first == last:
+                    edges = [(start, end)]
+                else:
+                    edges = [(start, BOUNDS[first + 1]), (BOUNDS[last], end)]
+                for edge_start, edge_end in edges:
+                    for list_hash in self.indexed_hashes(edge_start, edge_end).values():
+                        digest ^= list_hash
+                # Lists written since the last compaction replace the hash the index has for them
+                low = bisect.bisect_left(ids, start)
+                high = len(ids) if end is None else bisect.bisect_left(ids, end)
+                for list_id in ids[low:high]:
+                    digest ^= indexed.get(list_id, 0) ^ hashes[list_id]
+                digests.append(digest)
+        return digests
+
+    def digest(self, start, end):
+        """Digest of the lists in [start, end)."""
+        return self.digests([(start, end)])[0]
+
+    def range_hashes(self, start, end):
+        """Hash of every list in [start, end)."""
+        with self.db.index_lock:
+            ids, hashes, _ = self.pending()
+            range_hashes = self.indexed_hashes(start, end)
+        for list_id in ids:
+            if in_range(list_id, start, end):
+                if hashes[list_id]:
+                    range_hashes[list_id] = hashes[list_id]
+                else:
+                    range_hashes.pop(list_id, None)
+        return range_hashes
+
+    def tree(self, ranges):
+        """Merkle tree over the digests of some ranges, as a heap: node i has children 2i and 2i + 1, leaves start at len // 2."""
+        size = 1
+        while size < len(ranges):
+            size *= 2
+        digests = self.digests(ranges)
+        nodes = [b''] * (2 * size)
+        for i in range(size):
+            digest = digests[i] if i < len(ranges) else 0
+            nodes[size + i] = digest.to_bytes(HASH_BYTES, 'big')
+        for i in range(size - 1, 0, -1):
+            nodes[i] = hashlib.blake2b(nodes[2 * i] + nodes[2 * i + 1], digest_size=HASH_BYTES).digest()
+        return nodes
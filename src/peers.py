@@ -0,0 +1,336 @@
+import os
+import time
+import heapq
+import queue
+import random
+import itertools
+import threading
+import collections
+import zmq
+from concurrent.futures import Future
+from codec import encode, decode
+
+PEER_TIMEOUT = 5.0  # Seconds to wait for the reply of another worker
+LATENCY_SAMPLES = 100  # Recent reply times kept per peer, for its p95
+LATENCY_MIN_SAMPLES = 20  # Below this, a peer's p95 is not trusted and HEDGE_DELAY is used
+LATENCY_TTL = 10.0  # Seconds after which a peer not heard from is tried again as if unknown
+HEDGE_DELAY = 0.05  # Seconds before hedging a read to a peer with too few samples
+
+class PeerStats:
+    """Recent reply times of a peer, and the requests it has not answered yet."""
+
+    def __init__(self):
+        self.average = 0.0  # Moving average of the reply time
+        self.samples = collections.deque(maxlen=LATENCY_SAMPLES)
+        self.updated = 0.0  # Time of the last reply
+        self.failed = 0.0  # Time of the last request the peer did not answer
+        self.failures = 0  # Requests it did not answer, kept out of the reply times
+        self.outstanding = 0
+
+    def record(self, latency):
+        self.average = latency if not self.samples else 0.8 * self.average + 0.2 * latency
+        self.samples.append(latency)
+        self.updated = time.time()
+
+    def fail(self):
+        """A request timed out, the time waited says nothing about how fast the peer replies."""
+        self.failures += 1
+        self.failed = time.time()
+
+    def p95(self):
+        if len(self.samples) < LATENCY_MIN_SAMPLES:
+            return None
+        samples = sorted(self.samples)
+        return samples[int(0.95 * (len(samples) - 1))]
+
+class PeerPool:
+    """Long-lived DEALER connections to the other workers, one per peer, shared by all the threads of a worker.
+
+    Only the I/O thread touches the sockets: other threads queue their requests and wake it up
+    through a pipe. Every request carries a correlation id in its envelope (which a REP or ROUTER
+    peer sends back untouched), so many requests can be in flight on one connection and each
+    reply resolves the Future of its own request. The reply times of every peer are tracked,
+    so reads can go to the replica answering fastest and be hedged to a second one.
+    """
+
+    def __init__(self, context, timeout=PEER_TIMEOUT):
+        self.context = context
+        self.timeout = timeout
+        self.commands = queue.Queue()
+        self.wake_read, self.wake_write = os.pipe()
+        os.set_blocking(self.wake_read, False)
+        self.connections = {}  # peer id -> DEALER socket
+        self.peer_of = {}  # DEALER socket -> peer id
+        self.pending = {}  # correlation id -> (Future, peer id, time it was sent)
+        self.deadlines = []  # Heap of (deadline, correlation id)
+        self.timers = []  # Heap of (time, sequence, callback), run by the I/O thread
+        self.stats = {}  # peer id -> PeerStats
+        self.stats_lock = threading.Lock()
+        self.counter = itertools.count()
+        self.poller = zmq.Poller()
+        self.poller.register(self.wake_read, zmq.POLLIN)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def send(self, peer, data, timeout=None):
+        """Send a raw payload to a peer, return a Future resolved with the raw reply."""
+        future = Future()
+        self.command(("send", peer, data, future, timeout or self.timeout))
+        return future
+
+    def request(self, peer, message, timeout=None, codec=None):
+        """Send a message to a peer, return a Future resolved with the decoded reply."""
+        reply = Future()
+
+        def done(raw):
+            try:
+                reply.set_result(decode(raw.result()))
+            except Exception as error:
+                reply.set_exception(error)
+
+        self.send(peer, encode(message, codec), timeout).add_done_callback(done)
+        return reply
+
+    def hedged_send(self, peers, data, hedge=True):
+        """Send a read to one of some replicas, and to a second one if the first is slower than usual.
+
+        The first replica is picked at random, weighted by how fast and how idle each one is. If
+        it has not answered within its p95 reply time, the next best replica gets the same read,
+        and replicas that fail are replaced by the next ones. A replica that does not have the list
+        yet is a miss too, the owner (the first of the peers) is asked next. Returns a Future
+        resolved with the first successful raw reply holding a list (or the last reply if none did).
+        """
+        ranked = self.rank(peers)
+        result = Future()
+        lock = threading.Lock()
+        state = {"next": 0, "outstanding": 0, "last": None}
+
+        def launch(hedging=False):
+            with lock:
+                if result.done() or state["next"] >= len(ranked) or (hedging and state["next"] > 1):
+                    return False
+                peer = ranked[state["next"]]
+                state["next"] += 1
+                state["outstanding"] += 1
+            self.send(peer, data).add_done_callback(done)
+            if hedge and not hedging:
+                self.after(self.hedge_delay(peer["id"]), lambda: launch(hedging=True))
+            return True
+
+        def done(reply):
+            with lock:
+                state["outstanding"] -= 1
+            error = reply.exception()
+            if error is None:
+                state["last"] = reply.result()
+                try:
+                    response = decode(state["last"])
+                except Exception:
+                    response = {}
+                if response.get("status") == "success" and response.get("list") is not None:
+                    settle(result, reply=state["last"])
+                    return
+                if response.get("status") == "success":
+                    # A replica the write did not reach yet, the owner acknowledged it
+                    with lock:
+                        if peers[0] in ranked[state["next"]:]:
+                            ranked.remove(peers[0])
+                            ranked.insert(state["next"], peers[0])
+            if not launch():
+                with lock:
+                    finished = state["outstanding"] == 0
+                if finished:
+                    settle(result, reply=state["last"], error=error if state["last"] is None else None)
+
+        if not launch():
+            result.set_exception(ConnectionError("No replica to send the request to"))
+        return result
+
+    def hedged_request(self, peers, message, hedge=True):
+        """hedged_send for a message, the Future is resolved with the decoded reply."""
+        reply = Future()
+
+        def done(raw):
+            try:
+                reply.set_result(decode(raw.result()))
+            except Exception as error:
+                reply.set_exception(error)
+
+        self.hedged_send(peers, encode(message), hedge).add_done_callback(done)
+        return reply
+
+    def rank(self, peers):
+        """Peers in the order to try them: the first drawn at random, weighted by speed and idleness, then the fastest first."""
+        now = time.time()
+        with self.stats_lock:
+            costs = []
+            for peer in peers:
+                stats = self.stats.get(peer["id"])
+                if stats is None or now - max(stats.updated, stats.failed) > LATENCY_TTL:
+                    cost = 0.0  # Not measured lately, worth a try
+                elif stats.failed > stats.updated:
+                    cost = float('inf')  # Failed since its last reply, tried last
+                else:
+                    cost = stats.average * (1 + stats.outstanding)
+                costs.append(cost)
+        if not peers:
+            return []
+        best = min(costs)
+        weights = [1.0 if cost <= best else best / cost for cost in costs] if best > 0 else [cost == 0 for cost in costs]
+        first = random.choices(range(len(peers)), weights)[0]
+        rest = sorted((i for i in range(len(peers)) if i != first), key=lambda i: costs[i])
+        return [peers[first]] + [peers[i] for i in rest]
+
+    def healthy(self, peer_id):
+        """Whether a peer answered since it last failed to, or failed long enough ago to be tried again."""
+        with self.stats_lock:
+            stats = self.stats.get(peer_id)
+            return stats is None or stats.failed < stats.updated or time.time() - stats.failed > LATENCY_TTL
+
+    def hedge_delay(self, peer_id):
+        with self.stats_lock:
+            stats = self.stats.get(peer_id)
+            p95 = stats.p95() if stats is not None else None
+        return HEDGE_DELAY if p95 is None else p95
+
+    def after(self, delay, callback):
+        """Run a callback on the I/O thread after a delay, it must not block."""
+        self.command(("timer", time.time() + delay, callback))
+
+    def sync(self, peers):
+        """Open connections to new peers and close the ones to peers that left the ring."""
+        self.command(("sync", list(peers)))
+
+    def close(self):
+        self.command(("close",))
+        self.thread.join()
+
+    def command(self, command):
+        self.commands.put(command)
+        os.write(self.wake_write, b'\x00')
+
+    def run(self):
+        while True:
+            timeout = None
+            if self.deadlines or self.timers:
+                next_time = min(heap[0][0] for heap in (self.deadlines, self.timers) if heap)
+                timeout = max(0, (next_time - time.time()) * 1000)
+            events = dict(self.poller.poll(timeout))
+
+            if self.wake_read in events:
+                try:
+                    os.read(self.wake_read, 4096)
+                except BlockingIOError:
+                    pass
+                while not self.commands.empty():
+                    command = self.commands.get()
+                    if command[0] == "send":
+                        self.do_send(*command[1:])
+                    elif command[0] == "sync":
+                        self.do_sync(command[1])
+                    elif command[0] == "timer":
+                        heapq.heappush(self.timers, (command[1], next(self.counter), command[2]))
+                    elif command[0] == "close":
+                        for peer_id in list(self.connections):
+                            self.disconnect(peer_id)
+                        os.close(self.wake_read)
+                        os.close(self.wake_write)
+                        return
+
+            for socket in events:
+                if socket in self.peer_of:
+                    self.receive(socket)
+            self.expire()
+            while self.timers and self.timers[0][0] <= time.time():
+                heapq.heappop(self.timers)[2]()
+
+    def connect(self, peer):
+        socket = self.connections.get(peer["id"])
+        if socket is None:
+            socket = self.context.socket(zmq.DEALER)
+            socket.setsockopt(zmq.LINGER, 0)
+            socket.connect(f"tcp://127.0.0.1:{peer['port']}")
+            self.connections[peer["id"]] = socket
+            self.peer_of[socket] = peer["id"]
+            self.poller.register(socket, zmq.POLLIN)
+        return socket
+
+    def disconnect(self, peer_id):
+        socket = self.connections.pop(peer_id)
+        del self.peer_of[socket]
+        self.poller.unregister(socket)
+        socket.close()
+        for correlation_id, (future, pending_peer, _) in list(self.pending.items()):
+            if pending_peer == peer_id:
+                del self.pending[correlation_id]
+                self.done(pending_peer)
+                resolve(future, error=ConnectionError(f"Peer {peer_id[:6]} left the ring"))
+
+    def do_send(self, peer, data, future, timeout):
+        if future.cancelled():
+            return
+        socket = self.connect(peer)
+        correlation_id = next(self.counter).to_bytes(8, 'big')
+        try:
+            # The empty frame ends the envelope, a REP peer sends the correlation id back with its reply
+            socket.send_multipart([correlation_id, b'', data], zmq.NOBLOCK)
+        except zmq.Again:
+            resolve(future, error=ConnectionError(f"Too many requests queued for peer {peer['id'][:6]}"))
+            return
+        self.pending[correlation_id] = (future, peer["id"], time.time())
+        with self.stats_lock:
+            self.stats.setdefault(peer["id"], PeerStats()).outstanding += 1
+        heapq.heappush(self.deadlines, (time.time() + timeout, correlation_id))
+
+    def do_sync(self, peers):
+        members = {peer["id"]: peer for peer in peers}
+        for peer_id in list(self.connections):
+            if peer_id not in members:
+                self.disconnect(peer_id)
+        for peer in members.values():
+            self.connect(peer)
+
+    def receive(self, socket):
+        while True:
+            try:
+                frames = socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            entry = self.pending.pop(frames[0], None)
+            if entry is not None:  # Otherwise the request already timed out
+                self.done(entry[1], time.time() - entry[2])
+                resolve(entry[0], result=frames[-1])
+
+    def expire(self):
+        now = time.time()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            _, correlation_id = heapq.heappop(self.deadlines)
+            entry = self.pending.pop(correlation_id, None)
+            if entry is not None:
+                self.done(entry[1], failed=True)
+                resolve(entry[0], error=TimeoutError(f"Peer {entry[1][:6]} did not answer in time"))
+
+    def done(self, peer_id, latency=None, failed=False):
+        """Account for a request a peer answered (or failed), with its reply time if it has one."""
+        with self.stats_lock:
+            stats = self.stats.setdefault(peer_id, PeerStats())
+            stats.outstanding -= 1
+            if failed:
+                stats.fail()
+            elif latency is not None:
+                stats.record(latency)
+
+def settle(future, reply=None, error=None):
+    """Resolve a Future shared by several requests, only the first one counts."""
+    try:
+        resolve(future, reply, error)
+    except Exception:
+        pass  # Already resolved
+
+def resolve(future, result=None, error=None):
+    if future.cancelled():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
@@ -0,0 +1,165 @@
+import time
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+REPLICATION_WINDOW = 8  # Replica pushes in flight per neighbor
+
+class NeighborQueue:
+    """Lists waiting to be pushed to one neighbor, and the pushes it has not answered yet."""
+
+    def __init__(self, neighbor):
+        self.neighbor = neighbor
+        self.queued = OrderedDict()  # list_id -> [futures, time of the oldest submit]
+        self.in_flight = {}  # list_id -> [futures, time of the oldest submit]
+        self.acked = 0
+        self.failed = 0
+        self.down = False  # A push failed: later lists become hints until the neighbor is caught up
+
+    def enqueue(self, list_id, futures, submitted, first=False):
+        if list_id in self.queued:
+            entry = self.queued[list_id]
+            entry[0].extend(futures)
+            entry[1] = min(entry[1], submitted)
+        else:
+            self.queued[list_id] = [futures, submitted]
+        if first:
+            self.queued.move_to_end(list_id, last=False)
+
+    def next_ready(self):
+        """The oldest queued list that is not being pushed already, None if there is none."""
+        for list_id in self.queued:
+            if list_id not in self.in_flight:
+                return list_id
+        return None
+
+class Replicator:
+    """Pushes flushed lists to their replicas in the background, without blocking any request thread.
+
+    Each neighbor has its own queue and at most `window` pushes in flight, so neighbors are
+    replicated to in parallel and a slow or dead one only delays itself. A list queued again
+    before it went out is sent once, with its latest state. submit() returns one Future per
+    replica, resolved with True once that replica acknowledged the list (False if it failed).
+    Once a push to a neighbor fails, its lists are stored as hints instead of being sent, and
+    resolved with False right away, until the worker replays the hints (see recovered()).
+    """
+
+    def __init__(self, worker, window=REPLICATION_WINDOW):
+        self.worker = worker  # Builds the replica messages and owns the peer connections
+        self.window = window
+        self.events = queue.Queue()
+        self.neighbors = {}  # neighbor id -> NeighborQueue
+        self.lock = threading.Lock()  # Guards the queues against stats()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, list_id, neighbors):
+        """Queue a list for every neighbor, return a Future per neighbor resolved when it acknowledges."""
+        futures = []
+        for neighbor in neighbors:
+            future = Future()
+            futures.append(future)
+            self.events.put(("submit", neighbor, list_id, future))
+        return futures
+
+    def forget(self, neighbor_id):
+        """Turn everything queued for a neighbor that left the ring into hints."""
+        self.events.put(("forget", neighbor_id))
+
+    def recovered(self, neighbor_id):
+        """The neighbor got its hints, push to it again."""
+        self.events.put(("recovered", neighbor_id))
+
+    def run(self):
+        while True:
+            event = self.events.get()
+            with self.lock:
+                if event[0] == "submit":
+                    _, neighbor, list_id, future = event
+                    state = self.neighbors.setdefault(neighbor["id"], NeighborQueue(neighbor))
+                    state.enqueue(list_id, [future], time.time())
+                    self.pump(state)
+                elif event[0] == "reply":
+                    self.on_reply(*event[1:])
+                elif event[0] == "forget":
+                    state = self.neighbors.pop(event[1], None)
+                    if state is not None:
+                        for list_id, (futures, _) in list(state.queued.items()) + list(state.in_flight.items()):
+                            self.worker.hints.add(state.neighbor, list_id)
+                            resolve(futures, False)
+                elif event[0] == "recovered":
+                    state = self.neighbors.get(event[1])
+                    if state is not None:
+                        state.down = False
+
+    def pump(self, state):
+        """Start pushes to a neighbor until its window is full, or store them as hints if it is down."""
+        while state.down and state.queued:
+            list_id, (futures, _) = state.queued.popitem(last=False)
+            self.worker.hints.add(state.neighbor, list_id)
+            resolve(futures, False)
+        while len(state.in_flight) < self.window:
+            list_id = state.next_ready()
+            if list_id is None:
+                return
+            entry = state.queued.pop(list_id)
+            message = self.worker.replica_message(state.neighbor, list_id)
+            if message.get("delta", message.get("list")) is None:  # Handed off since it was queued
+                resolve(entry[0], False)
+                continue
+            state.in_flight[list_id] = entry
+            reply = self.worker.peers.request(state.neighbor, message)
+            reply.add_done_callback(
+                lambda reply, neighbor_id=state.neighbor["id"], list_id=list_id:
+                    self.events.put(("reply", neighbor_id, list_id, reply))
+            )
+
+    def on_reply(self, neighbor_id, list_id, reply):
+        state = self.neighbors.get(neighbor_id)
+        if state is None or list_id not in state.in_flight:
+            return  # The neighbor left the ring, its futures were already resolved
+        entry = state.in_flight.pop(list_id)
+        try:
+            response = reply.result()
+        except (TimeoutError, ConnectionError) as error:
+            response = {"status": "error", "message": str(error)}
+
+        if response["status"] == "resync":
+            # The neighbor cannot apply the delta, push the full list next
+            self.worker.replica_vv.get(neighbor_id, {}).pop(list_id, None)
+            state.enqueue(list_id, *entry, first=True)
+        elif response["status"] == "success":
+            self.worker.acknowledge_replica(neighbor_id, list_id, response["vv"])
+            state.acked += 1
+            self.worker.print_success_replicate(list_id, state.neighbor)
+            resolve(entry[0], True)
+        else:
+            state.failed += 1
+            state.down = True
+            self.worker.hints.add(state.neighbor, list_id)
+            self.worker.print_unsuccessfully_replicate(list_id, state.neighbor)
+            resolve(entry[0], False)
+        self.pump(state)
+
+    def stats(self):
+        """Replication lag of every neighbor: pending pushes and the age of the oldest one."""
+        now = time.time()
+        with self.lock:
+            stats = {}
+            for neighbor_id, state in self.neighbors.items():
+                pending = list(state.queued.values()) + list(state.in_flight.values())
+                stats[neighbor_id] = {
+                    "port": state.neighbor["port"],
+                    "queued": len(state.queued),
+                    "in_flight": len(state.in_flight),
+                    "acked": state.acked,
+                    "failed": state.failed,
+                    "down": state.down,
+                    "lag": max((now - submitted for _, submitted in pending), default=0.0)
+                }
+            return stats
+
+def resolve(futures, acknowledged):
+    for future in futures:
+        if not future.done():
+            future.set_result(acknowledged)
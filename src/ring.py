@@ -0,0 +1,134 @@
+import bisect
+import hashlib
+
+VNODES = 512  # Default number of tokens (virtual nodes) per worker
+
+_tokens = {}  # (port, vnodes) -> tokens of a worker, they never change so they are hashed once
+
+def worker_id(port):
+    """Position of a worker in the ring."""
+    return hashlib.sha256(str(port).encode('utf-8')).hexdigest()
+
+def worker_tokens(worker):
+    """Tokens of a worker: its id, plus one hash per extra virtual node."""
+    key = (worker["port"], worker.get("vnodes", 1))
+    if key not in _tokens:
+        port, vnodes = key
+        _tokens[key] = [worker_id(port)] + [
+            hashlib.sha256(f"{port}#{i}".encode('utf-8')).hexdigest() for i in range(1, vnodes)
+        ]
+    return _tokens[key]
+
+class HashRing:
+    """Consistent-hash ring with the tokens kept sorted, so lookups are a binary search.
+
+    Each worker owns `vnodes` tokens (advertised in its heartbeat, so a bigger machine can
+    take a bigger share). The ring is only rebuilt when the membership changes, never per request.
+    """
+
+    def __init__(self, workers=()):
+        self.tokens = []  # Sorted tokens
+        self.owners = []  # Worker owning each token
+        self.workers = []  # Members, sorted by id
+        self.members = {}  # Members by id
+        self.signature = None  # Identifies the membership, two rings with the same one route alike
+        self.build(workers)
+
+    def build(self, workers):
+        """Rebuild the ring from the current members."""
+        self.workers = sorted(workers, key=lambda worker: worker["id"])
+        self.members = {worker["id"]: worker for worker in self.workers}
+        points = sorted((token, worker["id"], worker) for worker in self.workers for token in worker_tokens(worker))
+        self.tokens = [token for token, _, _ in points]
+        self.owners = [worker for _, _, worker in points]
+        members = [(worker["id"], worker.get("vnodes", 1)) for worker in self.workers]
+        self.signature = hashlib.sha256(repr(members).encode('utf-8')).hexdigest()
+
+    def __len__(self):
+        return len(self.workers)
+
+    def lookup(self, key):
+        """Worker owning the key: the owner of the first token greater than the key, wrapping around."""
+        if not self.tokens:
+            return None
+        index = bisect.bisect_right(self.tokens, key) % len(self.tokens)
+        return self.owners[index]
+
+    def walk(self, index, n):
+        """The first n distinct workers met clockwise from a token index."""
+        found = []
+        seen = set()
+        for i in range(len(self.tokens)):
+            worker = self.owners[(index + i) % len(self.tokens)]
+            if worker["id"] not in seen:
+                seen.add(worker["id"])
+                found.append(worker)
+                if len(found) == n:
+                    break
+        return found
+
+    def preference_list(self, key, n):
+        """The owner of the key followed by the next distinct workers clockwise, n workers at most."""
+        if not self.tokens:
+            return []
+        return self.walk(bisect.bisect_right(self.tokens, key), n)
+
+    def replica_peers(self, worker_id, n):
+        """Workers replicating the ranges a worker owns, with preference lists of size n."""
+        successors = {}
+        for index, owner in enumerate(self.owners):
+            if owner["id"] == worker_id:
+                for worker in self.walk(index, n)[1:]:
+                    successors[worker["id"]] = worker
+        return list(successors.values())
+
+    def __contains__(self, worker_id):
+        return worker_id in self.members
+
+def changed_ranges(old_ring, new_ring, n):
+    """Key ranges whose preference list of size n differs between two rings.
+
+    Yields (start, end, old_preference, new_preference) for the keys in [start, end), with an
+    end of None for the end of the key space. Between two consecutive tokens of either ring
+    every key has the same preference lists, so only those boundaries are looked at.
+    """
+    bounds = sorted(set(old_ring.tokens) | set(new_ring.tokens))
+    changed = None
+    for start, end in zip([""] + bounds, bounds + [None]):
+        old = old_ring.preference_list(start, n)
+        new = new_ring.preference_list(start, n)
+        ids = ([worker["id"] for worker in old], [worker["id"] for worker in new])
+        if changed is not None and changed[4] == ids:
+            changed[1] = end  # Same change as the previous range, extend it
+            continue
+        if changed is not None:
+            yield tuple(changed[:4])
+        changed = [start, end, old, new, ids] if ids[0] != ids[1] else None
+    if changed is not None:
+        yield tuple(changed[:4])
+
+def shared_ranges(ring, worker_a, worker_b, n):
+    """Key ranges [start, end) whose preference list of size n holds both workers, in key order."""
+    ranges = []
+    if not ring.tokens:
+        return ranges
+    bounds = [""] + ring.tokens + [None]
+    for i in range(len(bounds) - 1):
+        ids = [worker["id"] for worker in ring.walk(i % len(ring.tokens), n)]
+        if worker_a not in ids or worker_b not in ids:
+            continue
+        if ranges and ranges[-1][1] == bounds[i]:
+            ranges[-1] = (ranges[-1][0], bounds[i + 1])
+        else:
+            ranges.append((bounds[i], bounds[i + 1]))
+    return ranges
+
+def clip_ranges(ranges, start, end):
+    """The parts of some ranges [start, end) inside [start, end), end None meaning the end of the key space."""
+    clipped = []
+    for range_start, range_end in ranges:
+        lower = max(range_start, start)
+        upper = range_end if end is None else end if range_end is None else min(range_end, end)
+        if upper is None or lower < upper:
+            clipped.append((lower, upper))
+    return clipped
@@ -0,0 +1,238 @@
+import os
+import math
+import time
+import queue
+import random
+import socket
+import threading
+from codec import encode, decode
+
+MEMBERSHIP = os.environ.get("SDLE_MEMBERSHIP", "proxy")  # "proxy": heartbeats through the proxy, "swim": gossip
+SEEDS = [int(port) for port in os.environ.get("SDLE_SEEDS", "6000").split(",") if port]  # Workers to join through
+SWIM_PORT_OFFSET = 10000  # Membership traffic goes over UDP, on the worker port plus this offset
+PROBE_PERIOD = 1.0  # Seconds between two probes of a member
+PROBE_TIMEOUT = 0.3  # Seconds to wait for a direct ack before asking other members to probe
+INDIRECT_PROBES = 3  # Members asked to probe a member that did not answer
+SUSPECT_PERIODS = 5  # Probe periods a suspect member has to refute the suspicion before it is declared dead
+RETRANSMIT_MULT = 3  # Each update is piggybacked RETRANSMIT_MULT * log2(members) times
+MAX_PIGGYBACK = 8  # Updates piggybacked on a single message
+PUSH_PULL_PERIODS = 5  # Probe periods between two full membership exchanges with a random member
+
+ALIVE, SUSPECT, DEAD = "alive", "suspect", "dead"
+
+def swim_address(port):
+    return ("127.0.0.1", port + SWIM_PORT_OFFSET)
+
+class Swim:
+    """SWIM membership: failure detection and dissemination by gossip instead of the heartbeat proxy.
+
+    Every period a member probes one other member, round robin, and asks a few others to probe
+    it indirectly if it does not answer. A member nobody reached becomes suspect, and is declared
+    dead if it does not refute the suspicion within SUSPECT_PERIODS. Membership updates ride on
+    the probes and acks, so each member sends O(1) messages per period whatever the cluster size.
+    Every PUSH_PULL_PERIODS a member also swaps its whole membership with a random one, which
+    catches up members that missed updates, like many joining at once.
+    Joins and deaths are handed to `on_join`/`on_leave` from a thread of their own.
+    """
+
+    def __init__(self, worker_id, port, vnodes, on_join, on_leave, seeds=SEEDS):
+        self.id = worker_id
+        self.port = port
+        self.on_join = on_join
+        self.on_leave = on_leave
+        self.seeds = [seed for seed in seeds if seed != port]
+        # A restarted member starts from a higher incarnation, so it overrides its own death
+        self.incarnation = int(time.time() * 1000)
+        self.me = {"id": worker_id, "port": port, "vnodes": vnodes}
+        self.members = {}  # id -> {"id", "port", "vnodes", "incarnation", "status", "since"}
+        self.broadcasts = []  # [update, transmissions left], piggybacked on outgoing messages
+        self.waiting = {}  # seq -> (deadline, callback run when the ack arrives)
+        self.seq = 0
+        self.targets = []  # Probe order for the current round
+        self.lock = threading.Lock()
+        self.events = queue.Queue()  # Joins and deaths for the ring, delivered in order
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(("0.0.0.0", port + SWIM_PORT_OFFSET))
+
+    def start(self):
+        threading.Thread(target=self.receive, daemon=True).start()
+        threading.Thread(target=self.deliver, daemon=True).start()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def alive_members(self):
+        with self.lock:
+            return [member for member in self.members.values() if member["status"] != DEAD]
+
+    # Messages
+
+    def send(self, address, message):
+        message["from"] = dict(self.me, incarnation=self.incarnation)
+        message["updates"] = self.piggyback()
+        try:
+            self.socket.sendto(encode(message), address)
+        except OSError:
+            pass  # Unreachable members are found out by the probes
+
+    def piggyback(self):
+        """The updates sent the fewest times so far, at most MAX_PIGGYBACK of them."""
+        with self.lock:
+            self.broadcasts.sort(key=lambda broadcast: -broadcast[1])
+            updates = []
+            for broadcast in self.broadcasts[:MAX_PIGGYBACK]:
+                updates.append(broadcast[0])
+                broadcast[1] -= 1
+            self.broadcasts = [broadcast for broadcast in self.broadcasts if broadcast[1] > 0]
+            return updates
+
+    def broadcast(self, update):
+        """Queue an update for dissemination, replacing older updates about the same member."""
+        transmissions = RETRANSMIT_MULT * max(1, math.ceil(math.log2(len(self.members) + 2)))
+        self.broadcasts = [broadcast for broadcast in self.broadcasts if broadcast[0]["id"] != update["id"]]
+        self.broadcasts.append([update, transmissions])
+
+    def next_seq(self):
+        with self.lock:
+            self.seq += 1
+            return self.seq
+
+    def expect_ack(self, seq, timeout, callback):
+        with self.lock:
+            self.waiting[seq] = (time.time() + timeout, callback)
+
+    def receive(self):
+        while True:
+            data, address = self.socket.recvfrom(65536)
+            try:
+                self.handle(decode(data), address)
+            except Exception:
+                continue  # A malformed message must not stop the membership
+
+    def handle(self, message, address):
+        sender = message["from"]
+        self.apply(dict(sender, status=ALIVE))
+        for update in message.get("updates", ()):
+            self.apply(update)
+
+        kind = message["type"]
+        if kind == "ping":
+            self.send(address, {"type": "ack", "seq": message["seq"]})
+        elif kind == "ping_req":
+            # Probe the target for the requester and relay its ack
+            seq = self.next_seq()
+            relay = lambda address=address, seq=message["seq"]: self.send(address, {"type": "ack", "seq": seq})
+            self.expect_ack(seq, PROBE_PERIOD, relay)
+            self.send(swim_address(message["target"]), {"type": "ping", "seq": seq})
+        elif kind == "ack":
+            with self.lock:
+                waiting = self.waiting.pop(message["seq"], None)
+            if waiting is not None:
+                waiting[1]()
+        elif kind == "push_pull":
+            for update in message["members"]:
+                self.apply(update)
+            self.send(address, {"type": "sync", "members": self.member_updates()})
+        elif kind == "sync":
+            for update in message["members"]:
+                self.apply(update)
+
+    # Membership state
+
+    def member_updates(self):
+        with self.lock:
+            return [self.update_of(member) for member in self.members.values()]
+
+    def update_of(self, member):
+        return {key: member[key] for key in ("id", "port", "vnodes", "incarnation", "status")}
+
+    def apply(self, update):
+        """Merge an update into the membership, following the SWIM precedence rules."""
+        if update["id"] == self.id:
+            if update["status"] != ALIVE and update["incarnation"] >= self.incarnation:
+                # Refute a suspicion (or a death) about this member
+                with self.lock:
+                    self.incarnation = update["incarnation"] + 1
+                    self.broadcast(dict(self.me, incarnation=self.incarnation, status=ALIVE))
+            return
+
+        with self.lock:
+            member = self.members.get(update["id"])
+            if member is not None:
+                incarnation, status = update["incarnation"], update["status"]
+                if status == ALIVE and incarnation <= member["incarnation"]:
+                    return
+                if status == SUSPECT and (incarnation < member["incarnation"] or
+                                          (incarnation == member["incarnation"] and member["status"] != ALIVE)):
+                    return
+                if status == DEAD and (member["status"] == DEAD or incarnation < member["incarnation"]):
+                    return
+            previous = member["status"] if member is not None else DEAD
+            self.members[update["id"]] = dict(self.update_of(update), since=time.time())
+            self.broadcast(self.update_of(update))
+
+        worker = {"id": update["id"], "port": update["port"], "vnodes": update["vnodes"], "timestamp": time.time()}
+        if previous == DEAD and update["status"] != DEAD:
+            self.events.put((self.on_join, worker))
+        elif previous != DEAD and update["status"] == DEAD:
+            self.events.put((self.on_leave, worker))
+
+    def suspect(self, member):
+        self.apply(dict(self.update_of(member), status=SUSPECT))
+
+    def deliver(self):
+        while True:
+            callback, worker = self.events.get()
+            try:
+                callback(worker)
+            except Exception as error:
+                print(f"Membership change of worker {worker['port']} failed: {error}")
+
+    # Failure detection
+
+    def next_target(self):
+        with self.lock:
+            self.targets = [member_id for member_id in self.targets
+                            if member_id in self.members and self.members[member_id]["status"] != DEAD]
+            if not self.targets:
+                self.targets = [member_id for member_id, member in self.members.items() if member["status"] != DEAD]
+                random.shuffle(self.targets)
+            return self.members[self.targets.pop()] if self.targets else None
+
+    def probe(self, target):
+        acked = threading.Event()
+        seq = self.next_seq()
+        self.expect_ack(seq, PROBE_PERIOD, acked.set)
+        self.send(swim_address(target["port"]), {"type": "ping", "seq": seq})
+        if acked.wait(PROBE_TIMEOUT):
+            return
+        helpers = [member for member in self.alive_members() if member["id"] != target["id"]]
+        for helper in random.sample(helpers, min(INDIRECT_PROBES, len(helpers))):
+            self.send(swim_address(helper["port"]), {"type": "ping_req", "seq": seq, "target": target["port"]})
+        if not acked.wait(PROBE_PERIOD - PROBE_TIMEOUT):
+            self.suspect(target)
+
+    def check_timeouts(self):
+        now = time.time()
+        with self.lock:
+            expired = [member for member in self.members.values()
+                       if member["status"] == SUSPECT and now - member["since"] > SUSPECT_PERIODS * PROBE_PERIOD]
+            self.waiting = {seq: waiting for seq, waiting in self.waiting.items() if waiting[0] > now}
+        for member in expired:
+            self.apply(dict(self.update_of(member), status=DEAD))
+
+    def run(self):
+        periods = 0
+        while True:
+            started = time.time()
+            members = self.alive_members()
+            if not members:
+                # Joining: a seed answers with the whole membership instead of waiting for the gossip
+                for seed in self.seeds:
+                    self.send(swim_address(seed), {"type": "push_pull", "members": []})
+            elif periods % PUSH_PULL_PERIODS == 0:
+                self.send(swim_address(random.choice(members)["port"]), {"type": "push_pull", "members": self.member_updates()})
+            periods += 1
+            target = self.next_target()
+            if target is not None:
+                self.probe(target)
+            self.check_timeouts()
+            time.sleep(max(0, PROBE_PERIOD - (time.time() - started)))
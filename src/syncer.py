@@ -0,0 +1,68 @@
+import random
+import threading
+
+SYNC_INTERVAL = 5.0  # Seconds between background syncs while the server is reachable
+BACKOFF_BASE = 1.0  # First retry delay after a failed sync, doubled on every failure
+BACKOFF_MAX = 60.0
+
+class SyncEngine:
+    """Syncs a client's lists with the server from a background thread.
+
+    Every round pushes the dirty lists and pulls remote changes to all the others, both in a
+    single batched request. Local operations never wait for it. While the server cannot be
+    reached, rounds are retried with exponential backoff and jitter. Each round is reported to
+    `notify` as a dict, which the frontend can show whenever suits it.
+    """
+
+    def __init__(self, client, interval=SYNC_INTERVAL, notify=None):
+        self.client = client
+        self.interval = interval
+        self.notify = notify or (lambda event: None)
+        self.failures = 0
+        self.wake = threading.Event()
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+        self.wake.set()
+        self.thread.join()
+
+    def sync_now(self):
+        """Run a round as soon as possible, unless the engine is backing off."""
+        if self.failures == 0:
+            self.wake.set()
+
+    def delay(self):
+        if self.failures == 0:
+            return self.interval
+        backoff = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (self.failures - 1))
+        return backoff * random.uniform(0.5, 1.0)  # Jitter, so clients do not all retry at once
+
+    def run(self):
+        while not self.stopped:
+            if self.sync_round():
+                self.failures = 0
+            else:
+                self.failures += 1
+            delay = self.delay()
+            if self.failures:
+                self.notify({"event": "offline", "retry_in": delay})
+            self.wake.wait(delay)
+            self.wake.clear()
+
+    def sync_round(self):
+        """Push the dirty lists and pull remote changes, return False if the server could not be reached."""
+        pushed = self.client.sync_all()
+        if pushed.get("status") != "success":
+            return False
+        pulled = self.client.pull_changes()
+        if pulled is None:
+            return False
+        synced = [list_id for list_id, result in pushed["results"].items() if result.get("status") == "success"]
+        if synced or pulled:
+            self.notify({"event": "synced", "pushed": synced, "pulled": pulled})
+        return True
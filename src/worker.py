@@ -1,350 +1,912 @@
+import os
 import sys
 import zmq
+import json
+import shutil
 import time
+import queue
+import struct
+import itertools
+import collections
 import threading
-import hashlib
+import multiprocessing
+from concurrent.futures import as_completed
 from ORSet import ShoppingListORSet
 from database import Database
+from codec import encode, decode, BULK_CODEC
+from ring import HashRing, worker_id, changed_ranges, shared_ranges, clip_ranges, VNODES
+from coalescer import WriteCoalescer, FLUSH_WINDOW, FLUSH_MAX_PENDING
+from peers import PeerPool, PEER_TIMEOUT
+from replicator import Replicator, REPLICATION_WINDOW
+from dispatcher import Dispatcher, shard_address, shard_span, shard_of, PROCESSES
+from swim import Swim, MEMBERSHIP
+from hints import HintStore
 
 HEARTBEAT = 5
+HEARTBEAT_FRAME = struct.Struct('!32sHHd')  # Worker id, port, vnodes and timestamp of a heartbeat
+REPLICAS = int(os.environ.get("SDLE_N", 3))  # N: workers holding each list, its owner and the next distinct workers in the ring
+ACK_MODE = "flush"  # "flush": reply once the write is synced to disk, "early": reply before the group flush
+READ_QUORUM = int(os.environ.get("SDLE_R", 1))  # R: replicas, the owner included, whose state a read merges
+WRITE_QUORUM = int(os.environ.get("SDLE_W", 1))  # W: replicas, the owner included, that must have a write before the reply
+ACKS = {"none": 1, "one": 2, "all": REPLICAS}  # Write quorums of the "ack" field of a request
+HANDLERS = 8  # Threads serving requests
+LIST_LOCKS = 64  # Stripes of the per-list locks
+HANDOFF_BATCH = 256  # Lists per chunk when handing ranges off to a new replica
+HANDOFF_WINDOW = 4  # Chunks in flight per new replica
+HANDOFF_RETRY = 5.0  # Seconds before a failed handoff is resumed
+HINT_RETRY = 5.0  # Seconds between two replays of the hints of workers still in the ring
+ANTI_ENTROPY_INTERVAL = 30.0  # Seconds between two comparisons of the ranges shared with each neighbor
+CACHED_LISTS = 10000  # Lists kept in memory (and acknowledged vectors per neighbor), the least recently used are dropped first
 
 class Worker:
-    def __init__(self, port, xsub_addr="tcp://localhost:5555", xpub_addr="tcp://localhost:5556"):
+    def __init__(self, port, xsub_addr="tcp://localhost:5555", xpub_addr="tcp://localhost:5556",
+                 ack_mode=ACK_MODE, flush_window=FLUSH_WINDOW, flush_max_pending=FLUSH_MAX_PENDING, vnodes=VNODES,
+                 read_quorum=READ_QUORUM, write_quorum=WRITE_QUORUM, replication_window=REPLICATION_WINDOW, handlers=HANDLERS, shard=None,
+                 shards=1, membership=MEMBERSHIP):
         self.port = port
-        self.id = hashlib.sha256(str(port).encode('utf-8')).hexdigest()
-        self.lists = {}
-        self.db = Database(filename=f'database/worker{port}/shopping_lists.json')  # Initialize the database
+        self.id = worker_id(port)
+        self.vnodes = vnodes  # Tokens of this worker in the ring, proportional to its capacity
+        self.lists = collections.OrderedDict()  # LRU cache of the live lists, only lists in self.dirty are never dropped
+        self.dirty = {}  # list_id -> changes made in memory since the list was last persisted
+        self.lock = threading.RLock()  # Guards self.lists and self.dirty
+        # Serialize the requests, flushes and replica pushes touching the same list, other lists go in parallel
+        self.list_locks = [threading.RLock() for _ in range(LIST_LOCKS)]
+        self.shard = shard  # Shard process behind a Dispatcher, None if the worker is a single process
+        self.span = ("", None) if shard is None else shard_span(shard, shards)  # Keys this process stores
+        directory = store_directory(port, shard)
+        self.db = Database(filename=f'{directory}/shopping_lists.json', merkle=True)  # Initialize the database
+        self.handoff_file = f'{directory}/handoff.json'  # Progress of the current handoff, to resume it
+        self.cursors_lock = threading.Lock()
+        # Ring the lists were last placed for, saved so a restarted worker only hands off what changed while it was away
+        self.placed = HashRing(self.load_handoff().get("placed", []))
+        self.handoffs = queue.Queue()  # Membership changes waiting for the handoff thread
+        self.hints = HintStore(f'{directory}/hints.json')  # Lists the replicas missed, replayed once they are back
+        self.hints_due = threading.Event()  # Wakes the hint thread up when a worker rejoins
+        self.ack_mode = ack_mode
+        self.read_quorum = min(read_quorum, REPLICAS)
+        self.write_quorum = min(write_quorum, REPLICAS)  # Default for requests that do not set "w" (or "ack")
+        self.replicator = Replicator(self, replication_window)
+        self.coalescer = WriteCoalescer(self.persist_lists, self._replicate_data, flush_window, flush_max_pending)
+        self.replica_vv = {}  # neighbor id -> LRU of {list_id: version vector the neighbor acknowledged}
         self.context = zmq.Context()
-        self.socket = self.context.socket(zmq.REP)  # REP socket to receive requests from other workers
-        self.socket.bind(f"tcp://*:{port}")  # Binding to port for communication
+        self.socket = self.context.socket(zmq.ROUTER)  # ROUTER socket to receive requests from clients and workers
+        # Binding to port for communication, shards get their requests from the dispatcher bound to the port
+        self.socket.bind(f"tcp://*:{port}" if shard is None else shard_address(port, shard))
+        self.peers = PeerPool(self.context)  # Connections to the other workers, for forwarding and replication
+
+        self.handlers = handlers
+        self.requests = queue.Queue()  # (envelope, request) waiting for a handler thread
+        self.replies = queue.Queue()  # (envelope, reply) waiting to be sent by the front end
+        self.wake_read, self.wake_write = os.pipe()  # Wakes the front end up when a reply is queued
+        os.set_blocking(self.wake_read, False)
 
         self.poller = zmq.Poller() # Poller for the socket
         self.poller.register(self.socket, zmq.POLLIN) # Register the socket with the poller
+        self.poller.register(self.wake_read, zmq.POLLIN)
 
-        self.publisher = self.context.socket(zmq.PUB)
-        self.publisher.connect(xsub_addr)
-        
-        self.subscriber = self.context.socket(zmq.SUB)
-        self.subscriber.connect(xpub_addr)
-        self.subscriber.setsockopt_string(zmq.SUBSCRIBE, "")
+        self.membership = membership  # "proxy": heartbeats through the proxy, "swim": gossip between the workers
+        if membership == "swim":
+            if shard is not None:
+                raise ValueError("SWIM membership needs one process per worker")
+            self.swim = Swim(self.id, port, vnodes, self.add_to_ring, self.remove_from_ring)
+        else:
+            self.publisher = self.context.socket(zmq.PUB)
+            self.publisher.connect(xsub_addr)
 
-        self.neighbors = []  # set of neighboring workers
-        self.privious_neighbors = []  # set of previous neighboring workers
-        self.index = 0  # index of the worker in the ring
+            self.subscriber = self.context.socket(zmq.SUB)
+            self.subscriber.connect(xpub_addr)
+            self.subscriber.setsockopt_string(zmq.SUBSCRIBE, "")
+
+        self.neighbors = []  # workers replicating the ranges this worker owns
         
         # Ring for the workers
-        self.worker_ring = {}
+        self.worker_ring = {}  # Members by id, with their last heartbeat
+        self.ring = HashRing()  # Sorted tokens for routing, replaced on membership changes only
+        self.ring_lock = threading.RLock()  # Serializes membership changes between the heartbeat threads
 
 
-    def add_list(self, list_id):
-        """Add a new shopping list to the worker."""
-        self.lists[list_id] = ShoppingListORSet(listID=list_id)
-        self.db.add_list(list_id, self.lists[list_id].serialize())  # Store the shopping list in the database
 
+    def list_lock(self, list_id):
+        return self.list_locks[hash(list_id) % LIST_LOCKS]
 
-    def get_list(self, list_id):
-        """Get the current items in the shopping list with their quantities."""
-        if list_id not in self.lists:
+    def load_list(self, list_id, create=False):
+        """Get the in-memory shopping list, loading it from the database if needed (call with its list lock held)."""
+        with self.lock:
+            list = self.lists.get(list_id)
+            if list is not None:
+                self.lists.move_to_end(list_id)
+        if list is None:
             serialized_list = self.db.get_list(list_id)
             if serialized_list:
-                self.lists[list_id] = ShoppingListORSet(listID=list_id)
-                self.lists[list_id].deserialize(serialized_list)
-        list = self.lists.get(list_id)
-        return list.serialize() if list else None
+                list = ShoppingListORSet(listID=list_id)
+                list.deserialize(serialized_list)
+            elif create:
+                list = ShoppingListORSet(listID=list_id)
+            if list is not None:
+                with self.lock:
+                    list = self.lists.setdefault(list_id, list)
+                    self.evict()
+        return list
+
+    def evict(self):
+        """Drop the least recently used lists past CACHED_LISTS, except the ones with changes not persisted yet (call with self.lock held)."""
+        excess = len(self.lists) - CACHED_LISTS
+        if excess > 0:
+            for list_id in [list_id for list_id in itertools.islice(self.lists, excess) if list_id not in self.dirty]:
+                del self.lists[list_id]
+
+    def get_list(self, list_id):
+        """Get the current items in the shopping list with their quantities."""
+        with self.list_lock(list_id):
+            list = self.load_list(list_id)
+            return list.serialize() if list else None
+
+    def get_delta(self, list_id, since):
+        """Get only the part of the shopping list that is newer than the version vector `since`."""
+        with self.list_lock(list_id):
+            list = self.load_list(list_id)
+            return list.delta(since) if list else None
+
+    def list_response(self, list_id, request, message=None):
+        """Build the reply to a request, with a delta instead of the full list if the sender sent its version vector."""
+        response = {"status": "success"}
+        if message is not None:
+            response["message"] = message
+        with self.list_lock(list_id):
+            list = self.load_list(list_id)
+            if list is None:
+                response["list"] = None
+            elif "vv" in request:
+                response["delta"] = list.delta(request["vv"])
+                response["vv"] = dict(list.vv)
+            else:
+                response["list"] = list.serialize()
+                response["vv"] = dict(list.vv)
+        return response
+
+    def persist_lists(self, list_ids):
+        """Write a group of in-memory shopping lists to the database, synced to disk once."""
+        serialized_lists = {}
+        changes = {}  # list_id -> changes the serialized state includes
+        for list_id in list_ids:
+            with self.list_lock(list_id):
+                with self.lock:
+                    list = self.lists.get(list_id)
+                    changes[list_id] = self.dirty.get(list_id)
+                if list is not None:
+                    serialized_lists[list_id] = list.serialize()
+        if serialized_lists:
+            self.db.add_lists(serialized_lists)
+        with self.lock:
+            # Lists changed again meanwhile stay dirty until their next flush
+            for list_id, count in changes.items():
+                if self.dirty.get(list_id) == count:
+                    del self.dirty[list_id]
+            self.evict()
+
+    def merge_into(self, list_id, other_list):
+        """Merge a full list or a delta into the local list, return False if the delta cannot be applied."""
+        with self.list_lock(list_id):
+            list = self.load_list(list_id) or ShoppingListORSet(listID=list_id)
+            if list.merge(other_list) == -1:
+                return False
+            with self.lock:
+                self.lists[list_id] = list
+                self.lists.move_to_end(list_id)
+                self.dirty[list_id] = self.dirty.get(list_id, 0) + 1
+            return True
 
     def merge_lists(self, list_id, other_list):
-        """Merge two shopping lists."""
-        if list_id not in self.lists:
-            self.add_list(list_id)
+        """Merge two shopping lists, return the message and a Future resolved once the result is persisted."""
         self.print_merge_lists(other_list)
-        self.lists[list_id].merge(other_list)
-        self.db.add_list(list_id, self.lists[list_id].serialize())  # Update the shopping list in the database
-        return f"List {list_id} merged successfully."
+        if not self.merge_into(list_id, other_list):
+            return None, None
+        flushed = self.coalescer.submit(list_id, replicate=True)
+        return f"List {list_id} merged successfully.", flushed
 
 
     def merge_replicas(self, list_id, replica):
         """Merge a replica of the data from a neighboring worker."""
-        if list_id not in self.lists:
-            self.add_list(list_id)
         self.print_merge_replica(replica)
-        self.lists[list_id].merge(replica)
-        self.db.add_list(list_id, self.lists[list_id].serialize())  # Update the shopping list in the database
-        return f"Replica of list {list_id} merged successfully."
+        if not self.merge_into(list_id, replica):
+            return None, None
+        flushed = self.coalescer.submit(list_id, replicate=False)
+        return f"Replica of list {list_id} merged successfully.", flushed
 
-    def _replicate_data(self, list_id):
-        self.print_replicating_data(list_id)
-        """Replicate data to the next two neighboring workers."""
-        
+    def wait_acks(self, flushed, request):
+        """Wait for the write quorum: the local write plus W - 1 replicas, return how many replicas acknowledged it."""
+        write_quorum = request.get("w", ACKS.get(request.get("ack"), self.write_quorum))
+        if self.ack_mode == "flush" or write_quorum > 1:
+            replicated = flushed.result()  # Futures of the replica pushes, sent while the write was persisted
+        if write_quorum <= 1:
+            return None
+        needed = min(write_quorum - 1, len(replicated))
+        acks = 0
+        try:
+            for future in as_completed(replicated, timeout=PEER_TIMEOUT):
+                acks += future.result()
+                if acks >= needed:
+                    break
+        except TimeoutError:
+            pass  # Reply anyway, the count tells the client how far the write got
+        return acks
+
+    def read_lists(self, requests):
+        """Serve reads (list_id -> get_list request) from R replicas, this one included, all asked in parallel.
+
+        The states that answer are merged, which is safe for CRDTs, and the replicas found
+        behind the merged state are brought up to date in the background (read repair).
+        """
+        if self.read_quorum <= 1:
+            return {list_id: self.list_response(list_id, request) for list_id, request in requests.items()}
+        replies = {}
+        for list_id in requests:
+            replicas = [worker for worker in self.ring.preference_list(list_id, REPLICAS) if worker["id"] != self.id]
+            replies[list_id] = [(worker, self.peers.request(worker, {"action": "get_replica", "list_id": list_id})) for worker in replicas]
+
+        responses = {}
+        for list_id, request in requests.items():
+            local = self.get_list(list_id)
+            states = [local]
+            try:
+                for reply in as_completed([reply for _, reply in replies[list_id]], timeout=PEER_TIMEOUT):
+                    try:
+                        response = reply.result()
+                    except (TimeoutError, ConnectionError):
+                        continue
+                    if response.get("status") == "success":
+                        states.append(response["list"])
+                    if len(states) >= self.read_quorum:
+                        break
+            except TimeoutError:
+                pass  # Reply with the replicas that answered, the count tells the client
+
+            merged = ShoppingListORSet(listID=list_id)
+            for state in states:
+                if state:
+                    merged.merge(state)
+            response = {"status": "success", "replicas": len(states)}
+            if not any(states):
+                response["list"] = None
+            else:
+                self.read_repair(list_id, merged, local, replies[list_id])
+                if "vv" in request:
+                    response["delta"] = merged.delta(request["vv"])
+                else:
+                    response["list"] = merged.serialize()
+                response["vv"] = dict(merged.vv)
+            responses[list_id] = response
+        return responses
+
+    def read_repair(self, list_id, merged, local, replies):
+        """Write the merged state back to the replicas it is newer than, this one included."""
+        if is_behind(local, merged.vv):
+            self.merge_into(list_id, merged.serialize())
+            self.coalescer.submit(list_id, replicate=False)
         message = {
             "id": self.id,
             "port": self.port,
             "action": "merge_replicas",
             "list_id": list_id,
-            "list": self.get_list(list_id)
+            "list": merged.serialize()
         }
-        
-        for neighbor in self.neighbors:
-            # Establish connection with the targer worker
-            connection = self.context.socket(zmq.REQ)
-            connection.connect(f"tcp://127.0.0.1:{neighbor['port']}")
-            connection.send_json(message)
-            response = connection.recv_json()
-
-            if response["status"] == "success":
-                self.print_success_replicate(list_id, neighbor)
-            else:
-                self.print_unsuccessfully_replicate(list_id, neighbor)    
-            # Close the connection
-            connection.close()
-        
+        for worker, reply in replies:
+            reply.add_done_callback(lambda reply, worker=worker: self.repair_replica(worker, reply, message))
+
+    def repair_replica(self, worker, reply, message):
+        try:
+            response = reply.result()
+        except (TimeoutError, ConnectionError):
+            return  # Anti-entropy catches it up later
+        if response.get("status") == "success" and is_behind(response["list"], message["list"]["vv"]):
+            self.peers.request(worker, message)
+
+    def replica_message(self, neighbor, list_id):
+        """Build a merge_replicas message with what the neighbor has not acknowledged yet."""
+        message = {
+            "id": self.id,
+            "port": self.port,
+            "action": "merge_replicas",
+            "list_id": list_id
+        }
+        since = self.replica_vv.get(neighbor["id"], {}).get(list_id)
+        if since is None:
+            message["list"] = self.get_list(list_id)
+        else:
+            message["delta"] = self.get_delta(list_id, since)
+        return message
+
+    def acknowledge_replica(self, neighbor_id, list_id, vv):
+        """Remember the version vector a neighbor acknowledged for a list, so the next push is a delta."""
+        with self.lock:
+            acknowledged = self.replica_vv.setdefault(neighbor_id, collections.OrderedDict())
+            acknowledged[list_id] = vv
+            acknowledged.move_to_end(list_id)
+            if len(acknowledged) > CACHED_LISTS:
+                acknowledged.popitem(last=False)  # Its next push sends the full list
+
+    def request_worker(self, worker, message, codec=None):
+        """Send a request to another worker and wait for the reply, or an error if it does not answer."""
+        try:
+            return self.peers.request(worker, message, codec=codec).result()
+        except (TimeoutError, ConnectionError) as error:
+            return {"status": "error", "message": str(error)}
+
+    def _replicate_data(self, list_id):
+        """Queue the list for the other workers in its preference list, return the Futures of their acks."""
+        self.print_replicating_data(list_id)
+
+        preference_list = self.ring.preference_list(list_id, REPLICAS)
+        return self.replicator.submit(list_id, [worker for worker in preference_list if worker["id"] != self.id])
+
 
     def receive_updates(self):
+        """Front end: hand the requests to the handler threads and send back their replies."""
         while True:
             socks = dict(self.poller.poll())
 
-            if self.socket in socks and socks[self.socket] == zmq.POLLIN:
-                request = self.socket.recv_json()
-            
-            action = request.get("action")
-            list_id = request.get("list_id")
-            list = request.get("list")
+            if self.socket in socks:
+                while True:
+                    try:
+                        frames = self.socket.recv_multipart(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+                    # The envelope (sender identity, and the correlation id of a peer) ends with an empty frame
+                    if b'' in frames:
+                        delimiter = frames.index(b'')
+                        self.requests.put((frames[:delimiter + 1], frames[delimiter + 1]))
 
-            target_worker = None
-            sorted_workers = sorted(self.worker_ring.values(),key=lambda worker: hashlib.sha256(str(worker["port"]).encode('utf-8')).hexdigest())
+            if self.wake_read in socks:
+                try:
+                    os.read(self.wake_read, 4096)
+                except BlockingIOError:
+                    pass
+                while not self.replies.empty():
+                    envelope, reply = self.replies.get()
+                    self.socket.send_multipart(envelope + [reply])
 
-            for i in range(len(sorted_workers)):
-                if(sorted_workers[i]["id"] > list_id):
-                    target_worker = sorted_workers[i]["port"]
-                    break
+    def reply(self, envelope, reply):
+        """Queue an encoded reply for the front end, from any thread."""
+        self.replies.put((envelope, reply))
+        os.write(self.wake_write, b'\x00')
 
-            if target_worker is None:
-                target_worker = sorted_workers[0]["port"]
+    def handle_requests(self):
+        while True:
+            envelope, raw_request = self.requests.get()
+            try:
+                response = self.handle_request(raw_request)
+            except Exception as error:
+                response = {"status": "error", "message": str(error)}
+            if isinstance(response, dict):
+                self.reply(envelope, encode(response))
+            else:
+                # Forwarded: the owner replies later, and this thread moves on to the next request
+                response.add_done_callback(lambda forwarded, envelope=envelope: self.reply_forwarded(envelope, forwarded))
 
-            if action == "merge_replicas":
-                message = self.merge_replicas(list_id, list)
-                response = {"status": "success", "message": message, "list": self.get_list(list_id)}
-                self.socket.send_json(response)
+    def reply_forwarded(self, envelope, forwarded):
+        try:
+            self.reply(envelope, forwarded.result())  # Relayed as received, no need to decode it
+        except (TimeoutError, ConnectionError) as error:
+            self.reply(envelope, encode({"status": "error", "message": str(error)}))
+
+    def handle_request(self, raw_request):
+        """Serve one request, return the response or the Future of the owner's reply if it is forwarded."""
+        request = decode(raw_request)
+        action = request.get("action")
+        list_id = request.get("list_id")
+        list = request.get("delta", request.get("list"))
+
+        if action == "merge_replicas":
+            message, flushed = self.merge_replicas(list_id, list)
+            if flushed is None:
+                return {"status": "resync", "message": "Delta does not apply, send the full list."}
+            self.wait_acks(flushed, request)
+            response = self.list_response(list_id, request, message)
+            if "vv" not in request:
+                response.pop("list", None)  # The sender only needs the version vector
+            return response
+        if action == "stats":
+            return {
+                "status": "success",
+                "writes": self.coalescer.ops,
+                "flushes": self.coalescer.flushes,
+                "replication": self.replicator.stats()
+            }
+        if action == "get_ring":
+            return {"status": "success", "workers": ring_members(self.ring), "replicas": REPLICAS}
+        if action == "merge_many" or action == "get_many":
+            return self.handle_batch(action, request)
+        if action == "get_replica":
+            return {"status": "success", "list": self.get_list(list_id)}
+        if action == "handoff_batch":
+            return self.receive_handoff(request["lists"])
+        if action == "anti_entropy":
+            return self.serve_anti_entropy(request)
+
+        owner = self.coordinator(list_id)
+        preference_list = self.ring.preference_list(list_id, REPLICAS)
+        if (action == "get_list" or request.get("direct")) and self.replicates(list_id):
+            # Any replica serves reads, and the writes a client sends it while the owner does not answer
+            owner = {"id": self.id, "port": self.port}
+        if owner["id"] != self.id and request.get("direct"):
+            # The client routed with an outdated ring, it refreshes it instead of paying for a forward
+            return {"status": "not_owner", "message": f"List {list_id} is owned by worker {owner['port']}."}
+        if owner["id"] != self.id:
+            self.print_target_worker(owner["port"])
+            if action == "get_list":
+                # The fastest replica answers, a second one is asked too if it is slower than usual
+                return self.peers.hedged_send(preference_list, encode(dict(request, direct=True)))
+            return self.peers.send(owner, raw_request)
+        if action == "get_list":
+            return self.read_lists({list_id: request})[list_id]
+        elif action == "merge_lists":
+            return self.merge_batch({list_id: request})[list_id]
+        else:
+            return {"status": "error", "message": "Invalid action."}
+
+    def merge_batch(self, requests):
+        """Merge several lists (list_id -> merge_lists request), so their flushes are waited for together."""
+        responses = {}
+        merged = {}
+        for list_id, request in requests.items():
+            try:
+                message, flushed = self.merge_lists(list_id, request.get("delta", request.get("list")))
+            except Exception as error:
+                responses[list_id] = {"status": "error", "message": str(error)}
+                continue
+            if flushed is None:
+                responses[list_id] = {"status": "resync", "message": "Delta does not apply, send the full list."}
             else:
-                if(target_worker == self.port):
-                    if action == "get_list":
-                        response = {"status": "success", "list": self.get_list(list_id)}
-                        self.socket.send_json(response)
-                    elif action == "merge_lists":
-                        message = self.merge_lists(list_id, list)
-                        response = {"status": "success", "message": message, "list": self.get_list(list_id)}
-                        self.socket.send_json(response)
-                        self._replicate_data(list_id)
-                    else:
-                        response = {"status": "error", "message": "Invalid action."}
-                        self.socket.send_json(response)
+                merged[list_id] = (message, flushed)
+        for list_id, (message, flushed) in merged.items():
+            acks = self.wait_acks(flushed, requests[list_id])
+            responses[list_id] = self.list_response(list_id, requests[list_id], message)
+            if acks is not None:
+                responses[list_id]["acks"] = acks
+        return responses
 
-                else:
-                    self.print_target_worker(target_worker)
+    def handle_batch(self, action, request):
+        """Serve a merge_many or get_many: the lists owned here directly, the others in one sub-batch per owner, in parallel.
+
+        request["lists"] maps each list id to the fields of its merge_lists or get_list request,
+        the reply maps each list id to the reply it would have got on its own.
+        """
+        groups = {}  # owner id -> (owner, lists)
+        for list_id, list_request in request["lists"].items():
+            owner = self.coordinator(list_id)
+            if request.get("direct") and self.replicates(list_id):
+                owner = {"id": self.id, "port": self.port}  # Sent here while the owner does not answer
+            groups.setdefault(owner["id"], (owner, {}))[1][list_id] = list_request
+
+        results = {}
+        forwarded = []
+        for owner_id, (owner, lists) in groups.items():
+            if owner_id == self.id:
+                continue
+            if request.get("direct"):  # A sub-batch from a worker with another view of the ring
+                for list_id in lists:
+                    results[list_id] = {"status": "not_owner", "message": f"List {list_id} is owned by worker {owner['port']}."}
+            else:
+                self.print_target_worker(owner["port"])
+                forwarded.append((lists, self.peers.request(owner, {"action": action, "lists": lists, "direct": True})))
 
-                    connection = self.context.socket(zmq.REQ)
-                    connection.connect(f"tcp://127.0.0.1:{target_worker}")
-                    connection.send_json(request)
-                    forwarded_response = connection.recv_json()
-                    connection.close()
-                    self.socket.send_json(forwarded_response)
+        local = groups.get(self.id, (None, {}))[1]
+        if action == "merge_many":
+            results.update(self.merge_batch(local))
+        else:
+            results.update(self.read_lists(local))
 
+        for lists, reply in forwarded:
+            try:
+                response = reply.result()
+            except (TimeoutError, ConnectionError) as error:
+                response = {"status": "error", "message": str(error)}
+            if response.get("status") == "success":
+                results.update(response["results"])
+            else:
+                for list_id in lists:
+                    results[list_id] = {"status": "error", "message": response.get("message")}
+        return {"status": "success", "results": results}
 
 
-    def determine_neighbors(self):
-        """Determine the neighboring workers in the ring."""
-        workers = list(self.worker_ring.values())
-        ring_size = len(workers)
+    def coordinator(self, list_id):
+        """Worker coordinating the writes to a list: its owner, or the next replica while the ones before do not answer."""
+        preference_list = self.ring.preference_list(list_id, REPLICAS)
+        for worker in preference_list:
+            if worker["id"] == self.id or self.peers.healthy(worker["id"]):
+                return worker
+        return preference_list[0] if preference_list else {"id": self.id, "port": self.port}
 
-        if ring_size <= 1:
+    def replicates(self, list_id):
+        return any(worker["id"] == self.id for worker in self.ring.preference_list(list_id, REPLICAS))
+
+    def determine_neighbors(self):
+        """Determine the workers that share preference lists with this one."""
+        if self.id not in self.ring:  # Our own heartbeat has not been added yet
             self.neighbors = []
-            self.previous_neighbors = []
             return
+        self.neighbors = self.ring.replica_peers(self.id, REPLICAS)
 
-        index = next(i for i, worker in enumerate(workers) if worker["id"] == self.id)
-        self.index = index
-
-        num_neighbors = 2 if ring_size > 2 else 1
-        self.neighbors = [
-            workers[(index + i) % ring_size]
-            for i in range(1, num_neighbors + 1)
-        ]
 
-        self.previous_neighbors = [
-            workers[(index - i) % ring_size]
-            for i in range(1, num_neighbors + 1)
-        ]
-        
+    def heartbeat(self, worker):
+        """Record a heartbeat: only the timestamp changes for a known worker, the ring is left alone."""
+        known = self.worker_ring.get(worker["id"])
+        if known is not None and known["vnodes"] == worker["vnodes"]:
+            known["timestamp"] = worker["timestamp"]
+        else:
+            self.add_to_ring(worker)
 
     def add_to_ring(self, worker):
         """Add/Update a worker to the ring."""
-        len_before = len(self.worker_ring)
-        self.worker_ring[worker["id"]] = worker
-        len_after = len(self.worker_ring)
-        self.worker_ring = dict(sorted(self.worker_ring.items(), key=lambda item: item[1]['id']))
-        if len_after > len_before:
-            self.print_add_ring(worker)
-            self.adjust_data_add(worker)
-        self.determine_neighbors()
-        
+        with self.ring_lock:
+            known = self.worker_ring.get(worker["id"])
+            self.worker_ring[worker["id"]] = worker
+            if known is None or known["vnodes"] != worker["vnodes"]:
+                self.ring = HashRing(self.worker_ring.values())
+                self.print_add_ring(worker)
+                self.sync_peers()
+                self.determine_neighbors()
+                self.rebalance(joined=True)
+                self.hints_due.set()
+
 
     def remove_from_ring(self, worker):
         """Remove a worker from the ring."""
-        if worker["id"] in self.worker_ring:
-            del self.worker_ring[worker["id"]]
-        self.determine_neighbors()
+        with self.ring_lock:
+            if worker["id"] in self.worker_ring:
+                del self.worker_ring[worker["id"]]
+                self.ring = HashRing(self.worker_ring.values())
+                with self.lock:
+                    self.replica_vv.pop(worker["id"], None)
+                self.replicator.forget(worker["id"])
+                self.sync_peers()
+                self.determine_neighbors()
+                self.rebalance(joined=False)
+
+    def sync_peers(self):
+        """Keep one connection open to every other worker in the ring."""
+        self.peers.sync(worker for worker in self.worker_ring.values() if worker["id"] != self.id)
 
     def check_heartbeats(self):
-        for worker in list(self.worker_ring.keys()):
-            if time.time() - self.worker_ring[worker]["timestamp"] > HEARTBEAT:
-                self.adjust_data_remove(self.worker_ring[worker])
+        now = time.time()
+        for worker, member in list(self.worker_ring.items()):
+            if now - member["timestamp"] > HEARTBEAT:
                 self.print_fail_heartbeat(worker)
-                self.remove_from_ring(self.worker_ring[worker])
-                
-                
-    def adjust_data_remove(self, worker_breakdown):
-        
-        workers = list(self.worker_ring.values())
-        ring_size = len(workers)
-        
-        if ring_size < 4:
-            return
-        
-        index = next(i for i, worker in enumerate(workers) if worker["id"] == worker_breakdown["id"])
-        
-        next_neighbor_index = (index + 1) % ring_size
-        prev_neighbor_index = (index - 1) % ring_size
-        
-        if (next_neighbor_index != self.index and prev_neighbor_index != self.index):
-            return
-        
-        # Next Neighbor
-        if (next_neighbor_index == self.index):
-            self.print_remove_worker()
-            neighbor_0 = self.neighbors[0]
-            neighbor_1 = self.neighbors[1]
-            neighbor_0_id = self.neighbors[0]["id"]
-            prev_neighbor_0_id = self.previous_neighbors[0]["id"]
-            prev_neighbor_1_id = self.previous_neighbors[1]["id"]
-
-            for list_id in self.lists.keys():
-                # Add to neighbor[1]
-                if list_id < prev_neighbor_1_id or (prev_neighbor_1_id < neighbor_0_id and neighbor_0_id < list_id):
-                    self.adjust_data(neighbor_0, list_id)
-
-                # Add to neighbor[2]
-                elif prev_neighbor_1_id < list_id < prev_neighbor_0_id or (prev_neighbor_0_id < prev_neighbor_1_id and (list_id > prev_neighbor_1_id or list_id < prev_neighbor_0_id)):
-                    self.adjust_data(neighbor_1, list_id)
-        
-        # Previous Neighbor
-        elif (prev_neighbor_index == self.index):
-            self.print_remove_worker()
-            neighbor_1 = self.neighbors[1]
-            prev_neighbor_0_id = self.previous_neighbors[0]["id"]
-            prev_neighbor_1_id = self.previous_neighbors[1]["id"]
-            
-            for list_id in self.lists.keys():
-                # Add to neighbor[0]
-                if prev_neighbor_1_id < list_id < prev_neighbor_0_id or (prev_neighbor_0_id < prev_neighbor_1_id and (list_id > prev_neighbor_1_id or list_id < prev_neighbor_0_id)):
-                    self.adjust_data(neighbor_1, list_id)
-                    
-            
-    def adjust_data_add(self, worker_added):
-        
-        workers = list(self.worker_ring.values())
-        ring_size = len(workers)
-        
-        if ring_size < 2:
-            return
-        
-        index = next(i for i, worker in enumerate(workers) if worker["id"] == worker_added["id"])
-        
-        next_neighbor0_index = (index + 1) % ring_size
-        next_neighbor1_index = (index + 2) % ring_size
-        next_neighbor2_index = (index + 3) % ring_size
-        
-        if ring_size < 4:
-            if (self.index == next_neighbor0_index):
-                for list_id in self.lists.keys():
-                    self.adjust_data(worker_added, list_id)
-            return
-        
-        if (self.index == next_neighbor0_index):
-            self.print_add_worker()
-            for list_id in list(self.lists.keys()):
-                if (list_id < worker_added["id"]) or (self.id < self.previous_neighbors[1]["id"] and list_id > self.previous_neighbors[1]["id"]):
-                    self.adjust_data(worker_added, list_id)
-                
-                if (self.previous_neighbors[1]["id"] < self.id and list_id < self.previous_neighbors[1]["id"]) or (self.previous_neighbors[1]["id"] > self.id and self.id < list_id < self.previous_neighbors[1]["id"]):
-                    self.db.delete_list(list_id)
-                    del self.lists[list_id]
-                    
-        elif (self.index == next_neighbor1_index):
-            self.print_add_worker()
-            for list_id in list(self.lists.keys()):  
-                if (self.previous_neighbors[1]["id"] < self.id and list_id < self.previous_neighbors[1]["id"]) or (self.previous_neighbors[1]["id"] > self.id and self.id < list_id < self.previous_neighbors[1]["id"]):
-                    self.db.delete_list(list_id)
-                    del self.lists[list_id]
-                    
-        elif (self.index == next_neighbor2_index):
+                self.remove_from_ring(member)
+
+
+    def rebalance(self, joined):
+        """Hand the lists whose preference list changed to their new replicas, from the handoff thread."""
+        self.handoffs.put(joined)
+
+    def run_handoffs(self):
+        """Bring the data placement up to date with the latest ring, one membership change or more at a time."""
+        # After a restart, give the ring time to see the members the lists were placed for again,
+        # so they do not look like they left and joined back; one still missing by then is dead
+        deadline = time.time() + HEARTBEAT
+        while time.time() < deadline and any(worker["id"] not in self.ring for worker in self.placed.workers):
+            time.sleep(0.1)
+        while True:
+            joined = self.handoffs.get()
+            while not self.handoffs.empty():  # Catch up with all the changes queued meanwhile at once
+                joined = self.handoffs.get()
+            ring = self.ring
+            done = self.handoff(self.placed, ring, joined)
+            if done:
+                self.placed = ring
+                with self.cursors_lock:
+                    self.save_handoff({"placed": ring_members(ring)})
+            elif done is not None:
+                # A new replica did not take its lists, retry from where it stopped
+                threading.Timer(HANDOFF_RETRY, self.handoffs.put, args=(joined,)).start()
+            # None: the ring changed during the handoff, its queued change starts the next one
+
+    def handoff(self, old_ring, new_ring, joined):
+        """Stream the ranges whose preference list changed to their new replicas, then drop the ones not replicated here anymore.
+
+        Returns True once everything was handed off, False if a new replica failed and None if
+        the ring changed in the middle, the lists are only dropped in the first case.
+        """
+        transfers = {}  # worker id -> (worker, ranges to send to it)
+        handed_off = []  # Ranges this worker no longer replicates
+        for start, end, old_preference_list, new_preference_list in changed_ranges(old_ring, new_ring, REPLICAS):
+            old_ids = [worker["id"] for worker in old_preference_list]
+            new_ids = [worker["id"] for worker in new_preference_list]
+            # The first previous replica still alive hands the range to the new replicas,
+            # a worker that was not a replica passes on whatever copy it has
+            holders = [worker_id for worker_id in old_ids if worker_id in new_ring]
+            if self.id not in old_ids or holders[0] == self.id:
+                for worker in new_preference_list:
+                    if worker["id"] not in old_ids and worker["id"] != self.id:
+                        transfers.setdefault(worker["id"], (worker, []))[1].append((start, end))
+            if self.id not in new_ids:
+                handed_off.append((start, end))
+
+        if not transfers and not handed_off:
+            return True
+        if joined:
             self.print_add_worker()
-            for list_id in list(self.lists.keys()):
-                if (worker_added["id"] < self.id and list_id < worker_added["id"]) or (worker_added["id"] > self.id and self.id < list_id < worker_added["id"]):
+        else:
+            self.print_remove_worker()
+
+        job = handoff_job(old_ring, new_ring)
+        cursors = self.load_cursors(job)
+        # One stream per new replica, so a slow or dead one does not hold up the others
+        streamed = {}  # worker id -> True, False or None, like this method returns
+
+        def stream(worker, ranges):
+            streamed[worker["id"]] = self.stream_ranges(worker, ranges, new_ring, job, cursors)
+
+        streams = [threading.Thread(target=stream, args=transfer, daemon=True) for transfer in transfers.values()]
+        for stream in streams:
+            stream.start()
+        for stream in streams:
+            stream.join()
+        if None in streamed.values():
+            return None
+        if not all(streamed.values()):
+            return False
+
+        for start, end in handed_off:
+            with self.lock:
+                loaded = [list_id for list_id in self.lists if list_id >= start and (end is None or list_id < end)]
+            for list_id in sorted(set(self.db.iter_list_ids(start, end)) | set(loaded)):
+                with self.list_lock(list_id), self.lock:
                     self.db.delete_list(list_id)
-                    del self.lists[list_id]
+                    self.lists.pop(list_id, None)
+                    self.dirty.pop(list_id, None)
+                    for acknowledged in self.replica_vv.values():
+                        acknowledged.pop(list_id, None)
+        self.save_cursors(None, {})
+        return True
 
+    def stream_ranges(self, worker, ranges, ring, job, cursors):
+        """Send the stored lists of some key ranges to a worker, in batches with a few of them in flight.
+
+        Lists are sent in key order, so the cursor (the last list the worker acknowledged, along
+        with every list before it) is enough to resume a handoff that failed or was interrupted.
+        """
+        cursor = cursors.get(worker["id"], "")
+        in_flight = collections.deque()  # (last list of the batch, Future of the reply), in the order they were sent
+        sent = 0
+
+        def batches():
+            batch = {}
+            for start, end in ranges:
+                for list_id in self.db.iter_list_ids(max(start, cursor), end):
+                    if list_id <= cursor:
+                        continue
+                    serialized_list = self.stored_list(list_id)
+                    if serialized_list is not None:
+                        batch[list_id] = serialized_list
+                    if len(batch) >= HANDOFF_BATCH:
+                        yield batch
+                        batch = {}
+            if batch:
+                yield batch
+
+        def settle():
+            last, reply = in_flight.popleft()
+            try:
+                response = reply.result()
+            except (TimeoutError, ConnectionError) as error:
+                response = {"status": "error", "message": str(error)}
+            if response["status"] != "success":
+                self.print_failed_handoff(worker, response.get("message"))
+                return False
+            with self.cursors_lock:  # Shared by the streams to every new replica
+                cursors[worker["id"]] = last
+                self.save_cursors(job, cursors)
+            return True
+
+        for batch in batches():
+            if self.ring is not ring:
+                return None
+            in_flight.append((max(batch), self.peers.request(worker, {"action": "handoff_batch", "lists": batch}, codec=BULK_CODEC)))
+            sent += len(batch)
+            if len(in_flight) >= HANDOFF_WINDOW and not settle():
+                return False
+        while in_flight:
+            if not settle():
+                return False
+        if sent:
+            self.print_handoff(worker, sent)
+        return True
+
+    def stored_list(self, list_id):
+        """The serialized list, from memory if it is loaded, without loading it otherwise."""
+        with self.list_lock(list_id):
+            with self.lock:
+                list = self.lists.get(list_id)
+            if list is not None:
+                return list.serialize()
+        return self.db.get_list(list_id)
+
+    def receive_handoff(self, lists):
+        """Merge a batch of lists handed off by another worker, reply once they are persisted."""
+        flushed = []
+        for list_id, other_list in lists.items():
+            self.merge_into(list_id, other_list)
+            flushed.append(self.coalescer.submit(list_id, replicate=False))
+        for future in flushed:
+            future.result()
+        self.print_receive_handoff(len(lists))
+        return {"status": "success", "merged": len(lists)}
+
+    def load_handoff(self):
+        """Ring the lists were last placed for, and the cursors of the handoff in progress."""
+        try:
+            with open(self.handoff_file) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def save_handoff(self, saved):
+        temporary = self.handoff_file + ".tmp"
+        with open(temporary, "w") as file:
+            json.dump(saved, file)
+        os.replace(temporary, self.handoff_file)
+
+    def load_cursors(self, job):
+        """Cursors of a handoff interrupted by a failure or a restart, if it was for the same membership change."""
+        saved = self.load_handoff()
+        return saved["cursors"] if saved.get("job") == job else {}
+
+    def save_cursors(self, job, cursors):
+        self.save_handoff({"placed": ring_members(self.placed), "job": job, "cursors": cursors})
         
-        
-    def adjust_data(self, neighbor, list_id):
-        """Helper function to adjust data."""
-        message = {
+
+    def run_hints(self):
+        """Replay the hints of the workers in the ring, as soon as one rejoins and every HINT_RETRY otherwise."""
+        while True:
+            self.hints_due.wait(HINT_RETRY)
+            self.hints_due.clear()
+            for target_id in self.hints.targets():
+                worker = self.worker_ring.get(target_id)
+                if worker is not None and target_id != self.id:
+                    self.replay_hints(worker)
+
+    def replay_hints(self, worker):
+        """Send a worker the latest state of the lists it missed, in batches, and resume pushing to it."""
+        hints = self.hints.pending(worker["id"])
+        replayed = 0
+        for i in range(0, len(hints), HANDOFF_BATCH):
+            batch = hints[i:i + HANDOFF_BATCH]
+            lists = {list_id: self.stored_list(list_id) for list_id, _ in batch}
+            lists = {list_id: list for list_id, list in lists.items() if list}  # Lists handed off since are skipped
+            if lists:
+                response = self.request_worker(worker, {"action": "handoff_batch", "lists": lists}, BULK_CODEC)
+                if response["status"] != "success":
+                    return False
+            self.hints.remove(worker["id"], batch)
+            replayed += len(lists)
+        self.replicator.recovered(worker["id"])
+        if replayed:
+            self.print_replay_hints(worker, replayed)
+        return True
+
+    def run_anti_entropy(self):
+        """Periodically repair the lists a neighbor missed (or this worker did), whatever push or handoff was lost."""
+        while True:
+            time.sleep(ANTI_ENTROPY_INTERVAL)
+            if not self.db.merkle.ready:
+                continue  # Still hashing the lists of an older store
+            for neighbor in list(self.neighbors):
+                try:
+                    self.anti_entropy(neighbor)
+                except Exception as error:
+                    print(f"Anti-entropy with worker {neighbor['port']} failed: {error}")
+
+    def anti_entropy(self, neighbor):
+        """Compare the ranges shared with a neighbor, a span of keys at a time if it is split in shards differently."""
+        ring = self.ring
+        start, end = self.span
+        while True:
+            span = self.compare_span(neighbor, ring, (start, end))
+            if span is None or span[1] == end:
+                return
+            start = span[1]
+
+    def compare_span(self, neighbor, ring, span):
+        """Compare the Merkle trees of the ranges shared with a neighbor within a span, level by level from the root.
+
+        Only the children of the nodes that differ are sent on, so replicas in sync cost one
+        hash. Returns the span the neighbor covered, None if it could not compare.
+        """
+        request = {
+            "action": "anti_entropy",
             "id": self.id,
-            "port": self.port,
-            "action": "merge_replicas",
-            "list_id": list_id,
-            "list": self.get_list(list_id)
+            "ring": ring.signature,
+            "list_id": span[0] or "0" * 8,  # Routes the request to the shard holding the start of the span
+            "span": list(span)
         }
-        connection = self.context.socket(zmq.REQ)
-        connection.connect(f"tcp://127.0.0.1:{neighbor['port']}")
-        connection.send_json(message)
-        response = connection.recv_json()
-        if response["status"] == "success":
-            self.print_successfully_adjust_data(list_id, neighbor)
-        else:
-            self.print_unsuccessfully_adjust_data(list_id, neighbor)
-        connection.close()
-        
+        ranges = clip_ranges(shared_ranges(ring, self.id, neighbor["id"], REPLICAS), *span)
+        tree = self.db.merkle.tree(ranges)
+        leaves = len(tree) // 2
+        nodes = [1]
+        while True:
+            response = self.request_worker(neighbor, dict(request, nodes={str(i): tree[i].hex() for i in nodes}))
+            if response["status"] == "span":
+                return self.compare_span(neighbor, ring, tuple(response["span"]))
+            if response["status"] != "success":
+                return None
+            nodes = response["differ"]
+            if not nodes:
+                return span
+            if nodes[0] >= leaves:
+                break
+            nodes = [child for i in nodes for child in (2 * i, 2 * i + 1)]
+        self.repair(neighbor, request, [ranges[i - leaves] for i in nodes])
+        return span
+
+    def repair(self, neighbor, request, ranges):
+        """Swap the lists that differ with a neighbor in some ranges: their hashes first, then only the lists that diverged."""
+        hashes = {}
+        for start, end in ranges:
+            hashes.update(self.db.merkle.range_hashes(start, end))
+        request = dict(request, ranges=[list(r) for r in ranges], hashes={list_id: format(h, '032x') for list_id, h in hashes.items()})
+        response = self.request_worker(neighbor, request)
+        if response["status"] != "success":
+            return
+        if response["lists"]:
+            self.receive_handoff(response["lists"])
+        wanted = response["wanted"]
+        for i in range(0, len(wanted), HANDOFF_BATCH):
+            lists = {list_id: self.stored_list(list_id) for list_id in wanted[i:i + HANDOFF_BATCH]}
+            self.request_worker(neighbor, {"action": "handoff_batch", "lists": {k: v for k, v in lists.items() if v}}, BULK_CODEC)
+        if response["lists"] or wanted:
+            self.print_anti_entropy(neighbor, len(response["lists"]), len(wanted))
+
+    def serve_anti_entropy(self, request):
+        """Answer a neighbor comparing its Merkle tree: which nodes differ, or which lists once it reached the leaves."""
+        ring = self.ring
+        if request["ring"] != ring.signature:
+            return {"status": "error", "message": "Different views of the ring, compare later."}
+        if not self.db.merkle.ready:
+            return {"status": "error", "message": "Still hashing the stored lists, compare later."}
+        span = tuple(request["span"])
+        covered = clip_ranges([span], *self.span)
+        if covered != [span]:
+            return {"status": "span", "span": list(covered[0])}  # Another shard holds the rest
+
+        if "hashes" in request:
+            mine = {}
+            for start, end in request["ranges"]:
+                mine.update(self.db.merkle.range_hashes(start, end))
+            theirs = {list_id: int(h, 16) for list_id, h in request["hashes"].items()}
+            lists = {list_id: self.stored_list(list_id) for list_id, h in mine.items() if theirs.get(list_id) != h}
+            wanted = [list_id for list_id, h in theirs.items() if mine.get(list_id) != h]
+            return {"status": "success", "lists": {k: v for k, v in lists.items() if v}, "wanted": wanted}
+
+        ranges = clip_ranges(shared_ranges(ring, self.id, request["id"], REPLICAS), *span)
+        tree = self.db.merkle.tree(ranges)
+        differ = [int(i) for i, h in request["nodes"].items() if tree[int(i)].hex() != h]
+        return {"status": "success", "differ": sorted(differ)}
 
     def send_heartbeat(self):
         """Continuously send heartbeat messages."""
+        worker_id = bytes.fromhex(self.id)
         while True:
             message = {
                 "id": self.id,
                 "port": self.port,
+                "vnodes": self.vnodes,
                 "timestamp": time.time()
-                ## Add more fields here
             }
             # Update itself in the ring
-            self.add_to_ring(message)
-            self.publisher.send_pyobj(message)
+            self.heartbeat(message)
+            self.publisher.send(HEARTBEAT_FRAME.pack(worker_id, self.port, self.vnodes, message["timestamp"]))
             self.check_heartbeats() # Check for failed workers
             time.sleep(1)
 
     def receive_heartbeat(self):
         """Continuously listen for heartbeats from other workers and update their last heartbeat time."""
         while True:
-            message = self.subscriber.recv_pyobj()
-            # Ignore heartbeats from self
-            if message["id"] == self.id:
+            worker = decode_heartbeat(self.subscriber.recv())
+            # Ignore anything that is not a heartbeat, and heartbeats from self
+            if worker is None or worker["id"] == self.id:
                 continue
-            id = message["id"]
-            port = message["port"]
-            worker = {
-                "id": id,
-                "port": port,
-                "timestamp": message["timestamp"],
-                ## Add more fields here
-            }
-            self.add_to_ring(worker) # Add worker to ring
+            self.heartbeat(worker)
 
     def print_fail_heartbeat(self,worker):
         print('*************************************')
@@ -402,22 +964,39 @@ class Worker:
         print('**                                               **')
         print('***************************************************\n')
 
-    def print_successfully_adjust_data(self,list_id,neighbor):
+    def print_handoff(self, worker, count):
         print('*******************************************')
         print('**                                       **')
-        print(f'**   List {list_id[:6]} Successfully adjusted   **')
-        print(f"**   To neighbor {neighbor['port']} ({neighbor['id'][:6]}).          **")
+        print(f"**   Handed off {count} lists                 **")
+        print(f"**   To worker {worker['port']} ({worker['id'][:6]}).            **")
         print('**                                       **')
         print('*******************************************\n')
 
-    def print_unsuccessfully_adjust_data(self,list_id,neighbor):
+    def print_failed_handoff(self, worker, message):
         print('*************************************************')
-        print('**                                       **')
-        print(f'**   Failed to adjust List {list_id[:6]} Successfully   **')
-        print(f"**   To neighbor {neighbor['port']} ({neighbor['id'][:6]}).                **")
+        print('**                                             **')
+        print(f"**   Failed to hand off lists to worker {worker['port']}. **")
+        print(f"**   {message}")
         print('**                                             **')
         print('*************************************************\n')
 
+    def print_receive_handoff(self, count):
+        print('*******************************************')
+        print(f"**   Received {count} handed off lists.      **")
+        print('*******************************************\n')
+
+    def print_replay_hints(self, worker, count):
+        print('*******************************************')
+        print(f"**   Replayed {count} hinted lists             **")
+        print(f"**   To worker {worker['port']} ({worker['id'][:6]}).            **")
+        print('*******************************************\n')
+
+    def print_anti_entropy(self, neighbor, pulled, pushed):
+        print('*******************************************')
+        print(f"**   Anti-entropy with worker {neighbor['port']}:      **")
+        print(f"**   {pulled} lists pulled, {pushed} lists pushed.")
+        print('*******************************************\n')
+
     def print_add_worker(self):
         print('***************************************')
         print('** Worker was added! Adjusting data. **')
@@ -429,14 +1008,154 @@ class Worker:
         print('*****************************************\n')
 
     def start(self):
+        for _ in range(self.handlers):
+            threading.Thread(target=self.handle_requests, daemon=True).start()
         threading.Thread(target=self.receive_updates).start()
-        threading.Thread(target=self.send_heartbeat).start()
-        threading.Thread(target=self.receive_heartbeat).start()
+        threading.Thread(target=self.run_handoffs, daemon=True).start()
+        threading.Thread(target=self.run_anti_entropy, daemon=True).start()
+        threading.Thread(target=self.run_hints, daemon=True).start()
+        if self.membership == "swim":
+            self.add_to_ring({"id": self.id, "port": self.port, "vnodes": self.vnodes, "timestamp": time.time()})
+            self.swim.start()
+        else:
+            threading.Thread(target=self.send_heartbeat).start()
+            threading.Thread(target=self.receive_heartbeat).start()
 
     
 
+def is_behind(state, vv):
+    """Whether a serialized list (None if missing) lacks some of the updates of a version vector."""
+    known = state["vv"] if state else {}
+    return any(known.get(replica_id, 0) < counter for replica_id, counter in vv.items())
+
+def ring_members(ring):
+    return [{"id": worker["id"], "port": worker["port"], "vnodes": worker["vnodes"]} for worker in ring.workers]
+
+def handoff_job(old_ring, new_ring):
+    """Identifies a membership change, so a handoff resumes only where the same one stopped."""
+    return old_ring.signature + new_ring.signature
+
+def decode_heartbeat(frame):
+    """The worker announced by a heartbeat frame, None if the frame is not one."""
+    if len(frame) != HEARTBEAT_FRAME.size:
+        return None
+    worker_id, port, vnodes, timestamp = HEARTBEAT_FRAME.unpack(frame)
+    return {"id": worker_id.hex(), "port": port, "vnodes": vnodes, "timestamp": timestamp}
+
+def store_directory(port, shard):
+    """Directory of the stores of a worker, or of one of its shard processes."""
+    return f'database/worker{port}' if shard is None else f'database/worker{port}/shard{shard}'
+
+def reshard(port, shards):
+    """Move the lists and hints a worker stored under another number of processes to the shards owning them now.
+
+    Each shard only opens the store of its own span, so without this the lists of a worker restarted
+    with more (or fewer) processes would never be read again. Runs before any shard starts, and saves
+    the layout once everything is in place, so a worker restarted the same way scans nothing.
+    """
+    root = store_directory(port, None)
+    layout_file = f'{root}/shards.json'
+    try:
+        with open(layout_file) as file:
+            if json.load(file)["shards"] == shards:
+                return
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    os.makedirs(root, exist_ok=True)
+    current = [None] if shards == 1 else list(range(shards))
+    owner = lambda list_id: None if shards == 1 else shard_of(list_id, shards)
+    found = sorted(int(name[len("shard"):]) for name in os.listdir(root) if name.startswith("shard") and name[len("shard"):].isdigit())
+    sources = [shard for shard in [None] + found if has_store(store_directory(port, shard))]
+
+    stores = {
+        shard: (Database(filename=f'{store_directory(port, shard)}/shopping_lists.json', merkle=True),
+                Database(filename=f'{store_directory(port, shard)}/hints.json'))
+        for shard in current
+    }
+    placed = []
+    moved = 0
+    for source in sources:
+        directory = store_directory(port, source)
+        kept = source in current
+        for kind, name, key_of in ((0, 'shopping_lists.json', lambda key: key), (1, 'hints.json', lambda key: key.split(":", 1)[1])):
+            db = stores[source][kind] if kept else Database(filename=f'{directory}/{name}')
+            moved += move_stored(db, source, {shard: store[kind] for shard, store in stores.items()}, lambda key: owner(key_of(key)), kept)
+            if not kept:
+                db.close()
+        try:
+            with open(f'{directory}/handoff.json') as file:
+                placed = placed or json.load(file).get("placed", [])
+        except (OSError, ValueError):
+            pass
+        if not kept:
+            if source is None:
+                for name in os.listdir(root):
+                    if name.startswith(('shopping_lists.', 'hints.', 'handoff.json')):
+                        os.remove(f'{root}/{name}')
+            else:
+                shutil.rmtree(directory)
+    for shard, (lists, hints) in stores.items():
+        lists.close()
+        hints.close()
+        # Lists are placed for the same ring whatever the shard holding them, only the cursors are per span
+        handoff_file = f'{store_directory(port, shard)}/handoff.json'
+        if placed and not os.path.exists(handoff_file):
+            with open(handoff_file, "w") as file:
+                json.dump({"placed": placed}, file)
+
+    temporary = layout_file + ".tmp"
+    with open(temporary, "w") as file:
+        json.dump({"shards": shards}, file)
+    os.replace(temporary, layout_file)
+    if moved:
+        print(f"Moved {moved} stored lists and hints to the stores of {shards} processes")
+
+def has_store(directory):
+    return os.path.isdir(directory) and any(name.startswith(('shopping_lists.', 'hints.')) for name in os.listdir(directory))
+
+def move_stored(db, source, targets, owner, delete):
+    """Write the records of a store that another shard owns into the store of that shard, return how many moved."""
+    batches = {}
+    moved = 0
+    def flush(target):
+        batch = batches.pop(target)
+        targets[target].add_lists(batch)
+        if delete:  # Only once the owner has them synced, a crash before the layout is saved moves them again
+            for key in batch:
+                db.delete_list(key)
+        return len(batch)
+    for key in db.iter_list_ids():
+        target = owner(key)
+        if target == source:
+            continue
+        batches.setdefault(target, {})[key] = db.get_list(key)
+        if len(batches[target]) >= HANDOFF_BATCH:
+            moved += flush(target)
+    for target in list(batches):
+        moved += flush(target)
+    return moved
+
+def run_shard(port, vnodes, shard, shards):
+    # Every shard heartbeats with the id and port of the worker, so the ring sees a single node
+    worker = Worker(port, vnodes=vnodes, shard=shard, shards=shards)
+    worker.start()
+    # A shard must not outlive its dispatcher, it would keep announcing a worker nobody can reach
+    multiprocessing.parent_process().join()
+    os._exit(1)
+
 if __name__ == "__main__":
     # Receive port through command line arguments
     port = int(sys.argv[1])
-    worker = Worker(port)
-    worker.start()
\ No newline at end of file
+    vnodes = int(sys.argv[2]) if len(sys.argv) > 2 else VNODES
+    processes = int(sys.argv[3]) if len(sys.argv) > 3 else PROCESSES
+    reshard(port, processes)  # Lists stored under another number of processes go to the shards owning them now
+    if processes == 1:
+        worker = Worker(port, vnodes=vnodes)
+        worker.start()
+    else:
+        # Spawned, so the shards do not inherit any ZeroMQ state
+        spawn = multiprocessing.get_context("spawn")
+        for shard in range(processes):
+            spawn.Process(target=run_shard, args=(port, vnodes, shard, processes)).start()
+        dispatcher = Dispatcher(port, processes)
+        dispatcher.start()
\ No newline at end of file
@@ -0,0 +1,90 @@
+"""Size and encode/decode time of a shopping list, in the old tag format and as dots with each codec,
+and of the messages the workers exchange.
+
+    python tests/bench_codec.py [items] [operations per item] [replicas]
+"""
+import sys
+import json
+import time
+import uuid
+from datetime import datetime
+
+import conftest  # noqa: F401, puts src/ on the path
+from codec import CODECS, decode
+from ORSet import ShoppingListORSet
+
+ROUNDS = 200
+
+def old_format(items, operations):
+    """A list in the format of (item_name, quantity, uuid-timestamp tag) tuples."""
+    tag = lambda: f"{uuid.uuid4()}-{datetime.now().isoformat()}"
+    add_set = [[f"item {item}", 2, tag()] for item in range(items) for _ in range(operations)]
+    remove_set = [[f"item {item}", 1, tag()] for item in range(items) for _ in range(operations // 2)]
+    return {"listID": uuid.uuid4().hex, "add_set": add_set, "remove_set": remove_set}
+
+def dot_format(items, operations, replicas):
+    shopping_list = ShoppingListORSet()
+    for replica in range(replicas):
+        other = ShoppingListORSet(listID=shopping_list.listID, replica_id=uuid.uuid4().hex[:8])
+        for item in range(items):
+            for _ in range(operations // replicas):
+                other.add_item(f"item {item}", 2)
+            other.remove_item(f"item {item}", 1)
+        shopping_list.merge(other)
+    return shopping_list.serialize()
+
+def messages(dots):
+    """Typical messages and replies, from small control messages to a handoff batch."""
+    shopping_list = ShoppingListORSet()
+    shopping_list.deserialize(dots)
+    list_id = shopping_list.listID
+    replica_id = next(iter(shopping_list.vv))
+    small = ShoppingListORSet(listID=list_id, replica_id=replica_id)
+    small.add_item("milk", 2)
+    return {
+        "get_list": {"action": "get_list", "list_id": list_id, "direct": True},
+        "error reply": {"status": "error", "message": "Request timed out"},
+        "merge ack": {"status": "success", "vv": dict(shopping_list.vv), "delta": small.delta(small.vv)},
+        "delta push": {"action": "merge_replicas", "list_id": list_id, "delta": small.delta({})},
+        "swim ping": {"type": "ping", "seq": 1234, "from": {"id": "ab" * 32, "port": 6000, "vnodes": 512, "incarnation": 1700000000000}, "updates": []},
+        "get_list reply": {"status": "success", "list": dots, "vv": dict(shopping_list.vv)},
+        "handoff batch": {"action": "handoff_batch", "lists": {f"{i:064x}": dots for i in range(256)}},
+    }
+
+def timed(function, value):
+    started = time.perf_counter()
+    for _ in range(ROUNDS):
+        function(value)
+    return (time.perf_counter() - started) / ROUNDS * 1e6
+
+def report(label, value, codec):
+    data = codec.encode(value)
+    print(f"{label:<18}{codec.name:<8}{len(data):>10}{timed(codec.encode, value):>12.1f}{timed(decode, data):>12.1f}")
+
+def main():
+    items = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    operations = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    replicas = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+    print(f"{items} items, {operations} adds per item, {replicas} replicas")
+    print(f"{'format':<18}{'codec':<8}{'bytes':>10}{'encode us':>12}{'decode us':>12}")
+    old = old_format(items, operations)
+    dots = dot_format(items, operations, replicas)
+    report("tags", old, CODECS["json"])
+    for codec in CODECS.values():
+        report("dots", dots, codec)
+    # Decoding is only half of reading a list, the ORSet is then rebuilt from the record
+    for codec in CODECS.values():
+        data = codec.encode(dots)
+        started = time.perf_counter()
+        for _ in range(ROUNDS):
+            ShoppingListORSet().deserialize(decode(data))
+        print(f"{'load list':<18}{codec.name:<8}{'':>10}{'':>12}{(time.perf_counter() - started) / ROUNDS * 1e6:>12.1f}")
+    print()
+    print(f"{'message':<18}{'codec':<8}{'bytes':>10}{'encode us':>12}{'decode us':>12}")
+    for label, message in messages(dots).items():
+        for codec in CODECS.values():
+            report(label, message, codec)
+    assert json.loads(json.dumps(decode(CODECS["binary"].encode(dots)))) == json.loads(json.dumps(dots))
+
+if __name__ == '__main__':
+    main()
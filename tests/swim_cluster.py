@@ -0,0 +1,74 @@
+"""Local SWIM cluster: start N members in their own processes and check that they converge.
+
+    python tests/swim_cluster.py [members] [first port]
+
+Every member joins through the first one, so the script checks that all of them see each
+other, that two killed members are declared dead by everyone, and that malformed packets
+do not stop a member from answering.
+"""
+import os
+import sys
+import time
+import socket
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import swim
+
+MEMBERS = 50
+BASE_PORT = 7000
+CONVERGE_TIMEOUT = 120  # Seconds the members have to agree
+
+def member(port, seed, views):
+    alive = set()
+    node = swim.Swim(str(port), port, 1, lambda worker: alive.add(worker["port"]), lambda worker: alive.discard(worker["port"]), seeds=[seed])
+    node.start()
+    while True:
+        time.sleep(0.5)
+        views.put((port, sorted(alive)))
+
+def wait_for(processes, views, expected, label):
+    """Wait until every live member sees exactly the expected members besides itself."""
+    started = time.time()
+    seen = {}
+    while time.time() - started < CONVERGE_TIMEOUT:
+        while not views.empty():
+            port, alive = views.get()
+            seen[port] = alive
+        if all(seen.get(port) == sorted(expected - {port}) for port in processes):
+            print(f"{label} in {time.time() - started:.1f}s")
+            return True
+        time.sleep(0.2)
+    behind = [port for port in processes if seen.get(port) != sorted(expected - {port})]
+    print(f"{label}: {len(behind)} members did not converge, e.g. {behind[:5]}")
+    return False
+
+def main():
+    members = int(sys.argv[1]) if len(sys.argv) > 1 else MEMBERS
+    base_port = int(sys.argv[2]) if len(sys.argv) > 2 else BASE_PORT
+    ports = set(range(base_port, base_port + members))
+    views = multiprocessing.Queue()
+    processes = {}
+    for port in sorted(ports):
+        processes[port] = multiprocessing.Process(target=member, args=(port, base_port, views), daemon=True)
+        processes[port].start()
+
+    converged = wait_for(processes, views, ports, f"{members} members joined")
+
+    # Garbage and messages missing fields must be dropped, not kill the receive thread
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    for payload in (b'\x00garbage', swim.encode({"type": "ping"}), swim.encode({"from": {"id": "x"}})):
+        probe.sendto(payload, swim.swim_address(base_port))
+
+    dead = {base_port + 5, base_port + members // 2}
+    for port in dead:
+        processes.pop(port).kill()
+    converged = wait_for(processes, views, ports - dead, f"{len(dead)} deaths detected") and converged
+
+    for process in processes.values():
+        process.kill()
+    sys.exit(0 if converged else 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+import json
+import pytest
+from codec import CODECS, MAGIC, ORSET, encode, decode, peek_str
+from ORSet import ShoppingListORSet
+
+BINARY = CODECS["binary"]
+
+def plain(value):
+    """The value as JSON gives it back, the binary codec reads the ORSet entries as tuples."""
+    return json.loads(json.dumps(value))
+
+def round_trip(value):
+    data = BINARY.encode(value)
+    assert data[0] == MAGIC
+    return decode(data)
+
+def uses_orset_layout(value):
+    data = BINARY.encode(value)
+    return data[1] == ORSET
+
+def sample_list():
+    shopping_list = ShoppingListORSet(listID="list", replica_id="a")
+    shopping_list.add_item("milk", 3)
+    shopping_list.add_item("eggs", 300)
+    shopping_list.remove_item("milk", 1)
+    other = ShoppingListORSet(listID="list", replica_id="b")
+    other.merge(shopping_list)
+    other.add_item("milk", 70000)
+    shopping_list.merge(other)
+    return shopping_list
+
+@pytest.mark.parametrize("value", [
+    None, True, False, 0, 127, 128, -1, 2**63 - 1, -2**63, 2**64, -2**80, 1.5, "", "ação",
+    [], {}, [1, "a", "a", None], {"a": {"a": ["a", 1]}}, {"status": "success", "results": {}},
+    {f"key{i}": f"value{i % 70}" for i in range(200)},
+])
+def test_values_round_trip(value):
+    assert round_trip(value) == value
+
+def test_tuples_become_lists():
+    assert round_trip((1, ("a", 2))) == [1, ["a", 2]]
+
+def test_unsupported_type():
+    with pytest.raises(TypeError):
+        BINARY.encode({1, 2})
+
+def test_orset_round_trip():
+    shopping_list = sample_list()
+    record = dict(shopping_list.serialize(), synced_vv={"x": 1})
+    assert uses_orset_layout(record)
+    decoded = round_trip(record)
+    assert plain(decoded) == plain(record)
+    copy = ShoppingListORSet()
+    copy.deserialize(decoded)
+    assert dict(copy.get_list()) == dict(shopping_list.get_list())
+    assert copy.vv == shopping_list.vv
+
+def test_delta_round_trip():
+    shopping_list = sample_list()
+    delta = shopping_list.delta({"a": 1})
+    assert uses_orset_layout(delta)
+    assert plain(round_trip(delta)) == plain(delta)
+
+def test_empty_orset_round_trip():
+    value = {"listID": "list", "vv": {}, "items": {}}
+    assert uses_orset_layout(value)
+    assert round_trip(value) == value
+
+def test_orset_inside_a_message():
+    shopping_list = sample_list()
+    message = {"action": "merge_many", "lists": {"list": {"list": shopping_list.serialize(), "vv": dict(shopping_list.vv)}}}
+    assert plain(round_trip(message)) == plain(message)
+
+@pytest.mark.parametrize("value", [
+    # Negative counters do not fit the unsigned columns
+    {"listID": "list", "vv": {"a": 1}, "items": {"milk": {"a": [1, 2, -3]}}},
+    # A name containing the separator of the name column
+    {"listID": "list", "vv": {"a": 1}, "items": {"mi\x00lk": {"a": [1, 2, 0]}, "eggs": {"a": [1, 1, 0]}}},
+    # A dot of a replica missing from the version vector
+    {"listID": "list", "vv": {"a": 1}, "items": {"milk": {"b": [1, 2, 0]}}},
+    # Counters too large for 64 bits, entries of the wrong length or type
+    {"listID": "list", "vv": {"a": 2**64}, "items": {"milk": {"a": [1, 2, 0]}}},
+    {"listID": "list", "vv": {"a": 1}, "items": {"milk": {"a": [1, 2]}}},
+    {"listID": "list", "vv": {"a": 1}, "items": {"milk": {"a": [1, 2, 0, 4], "b": [1, 2, 0]}}},
+    {"listID": "list", "vv": {"a": 1}, "items": {"milk": {"a": [1, "2", 0]}}},
+    {"listID": "list", "vv": {"a": 1}, "items": {"milk": {"a": 1}}},
+    # Any dict with both keys goes through the ORSet layout first
+    {"vv": "not a vector", "items": []},
+    {"vv": {}, "items": {"milk": []}},
+])
+def test_orset_fallback(value):
+    assert not uses_orset_layout(value)
+    assert round_trip(value) == value
+
+def test_json_codec():
+    value = sample_list().serialize()
+    data = encode(value, CODECS["json"])
+    assert data[:1] == b'{'
+    assert decode(data) == plain(value)
+    assert decode(data.decode('utf-8')) == decode(data)
+
+def test_binary_is_smaller():
+    value = sample_list().serialize()
+    assert len(encode(value, BINARY)) < len(encode(value, CODECS["json"]))
+
+@pytest.mark.parametrize("codec", ["binary", "json"])
+def test_peek_str(codec):
+    data = encode({"action": "get_list", "list_id": "abc", "direct": True}, CODECS[codec])
+    assert peek_str(data, "action") == "get_list"
+    assert peek_str(data, "list_id") == "abc"
+    assert peek_str(data, "missing") is None
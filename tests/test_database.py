@@ -0,0 +1,158 @@
+import json
+import pytest
+from database import Database
+from merkle import state_hash
+from ORSet import ShoppingListORSet
+
+def plain(value):
+    """The value as JSON gives it back, the binary codec reads the ORSet entries as tuples."""
+    return json.loads(json.dumps(value))
+
+def make_list(quantity):
+    shopping_list = ShoppingListORSet(replica_id="a")
+    shopping_list.add_item("milk", quantity)
+    return shopping_list.listID, plain(shopping_list.serialize())
+
+@pytest.fixture
+def open_db(tmp_path):
+    """Opens databases in a temporary directory and closes them after the test."""
+    opened = []
+    def open_db(**options):
+        db = Database(filename=str(tmp_path / "shopping_lists.json"), **options)
+        opened.append(db)
+        return db
+    yield open_db
+    for db in opened:
+        try:
+            db.close()
+        except Exception:
+            pass
+
+def fill(db, count, deleted=0):
+    """Write some lists and delete the first few, return what the database should hold."""
+    truth = {}
+    for quantity in range(1, count + 1):
+        list_id, record = make_list(quantity)
+        db.add_list(list_id, record)
+        truth[list_id] = record
+    for list_id in list(truth)[:deleted]:
+        db.delete_list(list_id)
+        del truth[list_id]
+    return truth
+
+def check(db, truth):
+    assert sorted(db.get_lists()) == sorted(truth)
+    assert list(db.iter_list_ids()) == sorted(truth)
+    assert db.count_lists() == len(truth) == len(db.get_lists())
+    for list_id, record in truth.items():
+        assert plain(db.get_list(list_id)) == record
+        assert list_id in db.get_lists()
+
+def test_reopen_replays_the_log(open_db):
+    db = open_db()
+    truth = fill(db, 50, deleted=5)
+    db.close()
+    check(open_db(), truth)
+
+def test_reopen_after_compaction(open_db):
+    db = open_db(compact_threshold=10)
+    truth = fill(db, 100, deleted=10)
+    db.save()
+    db.close()
+    db = open_db(compact_threshold=10)
+    assert not db.tail
+    check(db, truth)
+
+def test_truncated_segment_drops_only_the_torn_record(open_db, tmp_path):
+    db = open_db()
+    truth = fill(db, 20)
+    db.close()
+    segment = max(tmp_path.glob("shopping_lists.json.*.log"), key=lambda path: path.stat().st_size)
+    segment.write_bytes(segment.read_bytes()[:-3])
+    del truth[list(truth)[-1]]
+
+    db = open_db()
+    check(db, truth)
+    # New records go to a fresh segment, never after the torn one
+    list_id, record = make_list(99)
+    db.add_list(list_id, record)
+    truth[list_id] = record
+    db.close()
+    check(open_db(), truth)
+
+def test_corrupt_record_is_not_replayed(open_db, tmp_path):
+    db = open_db()
+    truth = fill(db, 5)
+    db.close()
+    segment = max(tmp_path.glob("shopping_lists.json.*.log"), key=lambda path: path.stat().st_size)
+    data = bytearray(segment.read_bytes())
+    data[-1] ^= 0xff  # Fails the checksum of the last record
+    segment.write_bytes(bytes(data))
+    del truth[list(truth)[-1]]
+    check(open_db(), truth)
+
+def test_legacy_json_snapshot_is_migrated(open_db, tmp_path):
+    truth = dict(make_list(quantity) for quantity in range(1, 11))
+    (tmp_path / "shopping_lists.json").write_text(json.dumps(truth))
+    db = open_db()
+    check(db, truth)
+    assert not (tmp_path / "shopping_lists.json").exists()
+    db.close()
+    check(open_db(), truth)
+
+def test_legacy_json_lines_segment_is_replayed(open_db, tmp_path):
+    truth = dict(make_list(quantity) for quantity in range(1, 6))
+    lines = [json.dumps({"op": "put", "id": list_id, "list": record}) for list_id, record in truth.items()]
+    deleted = next(iter(truth))
+    lines.append(json.dumps({"op": "del", "id": deleted}))
+    del truth[deleted]
+    (tmp_path / "shopping_lists.json.1.log").write_text("\n".join(lines) + '\n{"op": "put", "id"')
+    check(open_db(), truth)
+
+def test_list_ids_merge_the_tail_with_the_index(open_db):
+    db = open_db(compact_threshold=1000)
+    truth = fill(db, 30)
+    db.save()
+    indexed = sorted(truth)
+    # Deletes and new lists in the tail, over lists already in the index
+    for list_id in indexed[::3]:
+        db.delete_list(list_id)
+        del truth[list_id]
+    truth.update(fill(db, 10))
+    list_id = indexed[1]
+    truth[list_id] = make_list(500)[1]
+    db.add_list(list_id, truth[list_id])
+    assert db.tail
+    check(db, truth)
+
+    ids = sorted(truth)
+    start, end = ids[5], ids[20]
+    assert list(db.iter_list_ids(start, end)) == ids[5:20]
+    assert list(db.iter_list_ids(start)) == ids[5:]
+
+def test_count_lists_ignores_deleting_missing_lists(open_db):
+    db = open_db()
+    truth = fill(db, 10)
+    db.delete_list("missing")
+    db.save()
+    db.delete_list("missing")
+    assert db.count_lists() == len(truth)
+
+def test_empty_database(open_db):
+    db = open_db()
+    assert not db.get_lists()
+    assert len(db.get_lists()) == 0
+    assert db.get_list("missing") == []
+    assert db.lookup("missing") == (False, None)
+
+def test_merkle_store_hashes_what_it_holds(open_db):
+    db = open_db(compact_threshold=10, merkle=True)
+    truth = fill(db, 40, deleted=4)
+    db.save()
+    truth.update(fill(db, 5))
+    digest = 0
+    for list_id, record in truth.items():
+        digest ^= state_hash(list_id, record)
+    assert db.merkle.digest("", None) == digest
+    db.close()
+    assert open_db(compact_threshold=10, merkle=True).merkle.digest("", None) == digest
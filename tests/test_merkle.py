@@ -0,0 +1,28 @@
+import codec
+from codec import CODECS, decode
+from merkle import state_hash
+from ORSet import ShoppingListORSet
+
+def sample_record():
+    shopping_list = ShoppingListORSet(listID="list", replica_id="a")
+    shopping_list.add_item("milk", 3)
+    shopping_list.remove_item("milk", 1)
+    return shopping_list.serialize()
+
+def test_hash_does_not_depend_on_the_codec(monkeypatch):
+    record = sample_record()
+    hashes = set()
+    for default in CODECS.values():
+        monkeypatch.setattr(codec, "WIRE_CODEC", default)
+        monkeypatch.setattr(codec, "STORAGE_CODEC", default)
+        # What each codec reads back too, the binary one gives tuples where JSON gives lists
+        for name in CODECS:
+            hashes.add(state_hash("list", decode(CODECS[name].encode(record))))
+    assert len(hashes) == 1
+
+def test_hash_follows_the_version_vector():
+    record = sample_record()
+    changed = dict(record, vv={"a": 3})
+    assert state_hash("list", record) != state_hash("list", changed)
+    assert state_hash("list", record) != state_hash("other", record)
+    assert state_hash("list", dict(record, vv=dict(reversed(list(record["vv"].items()))))) == state_hash("list", record)
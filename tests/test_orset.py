@@ -0,0 +1,125 @@
+import uuid
+from datetime import datetime
+from ORSet import ShoppingListORSet
+
+def replica(name, list_id="list"):
+    return ShoppingListORSet(listID=list_id, replica_id=name)
+
+def state(shopping_list):
+    return dict(shopping_list.get_list()), shopping_list.vv
+
+def test_add_and_remove():
+    shopping_list = replica("a")
+    shopping_list.add_item("milk", 3)
+    shopping_list.add_item("milk", 2)
+    shopping_list.remove_item("milk", 4)
+    assert dict(shopping_list.get_list()) == {"milk": 1}
+    assert shopping_list.vv == {"a": 3}
+
+def test_remove_missing_item():
+    shopping_list = replica("a")
+    assert shopping_list.remove_item("milk", 1) == -1
+    assert shopping_list.vv == {}
+
+def test_concurrent_changes_merge():
+    a, b = replica("a"), replica("b")
+    a.add_item("milk", 2)
+    b.merge(a.serialize())
+    a.add_item("eggs", 6)
+    b.remove_item("milk", 1)
+    b.add_item("milk", 4)
+    a.merge(b.serialize())
+    b.merge(a.serialize())
+    assert state(a) == state(b)
+    assert dict(a.get_list()) == {"milk": 5, "eggs": 6}
+
+def test_merge_is_idempotent_and_commutative():
+    a, b = replica("a"), replica("b")
+    a.add_item("milk", 2)
+    b.add_item("bread", 1)
+    b.remove_item("bread", 1)
+    left, right = replica("x"), replica("y")
+    left.merge(a.serialize())
+    left.merge(b.serialize())
+    right.merge(b)
+    right.merge(a)
+    assert state(left) == state(right)
+    merged = state(left)
+    left.merge(a.serialize())
+    left.merge(b.serialize())
+    left.merge(left.serialize())
+    assert state(left) == merged
+
+def test_delta_brings_only_new_entries():
+    a, b = replica("a"), replica("b")
+    a.add_item("milk", 2)
+    a.add_item("eggs", 6)
+    b.merge(a.serialize())
+    since = dict(b.vv)
+    a.add_item("eggs", 6)
+    delta = a.delta(since)
+    assert delta["vv"] == {"a": 3}
+    assert list(delta["items"]) == ["eggs"]
+    assert a.delta(a.vv)["items"] == {}
+    b.merge(delta)
+    assert state(b) == state(a)
+
+def test_delta_merge_is_idempotent():
+    a, b = replica("a"), replica("b")
+    a.add_item("milk", 2)
+    delta = a.delta({})
+    b.merge(delta)
+    b.merge(delta)
+    assert state(b) == state(a)
+
+def test_can_merge():
+    a, b = replica("a"), replica("b")
+    a.add_item("milk", 2)
+    first = a.delta({})
+    a.add_item("eggs", 6)
+    second = a.delta(first["vv"])
+    # The second delta needs the first one, a full list or a delta from nothing can always be merged
+    assert not b.can_merge(second)
+    assert b.merge(second) == -1
+    assert b.vv == {}
+    assert b.can_merge(first) and b.can_merge(a.serialize()) and b.can_merge(a)
+    b.merge(first)
+    assert b.can_merge(second)
+    b.merge(second)
+    assert state(b) == state(a)
+
+def test_serialize_round_trip():
+    a = replica("a")
+    a.add_item("milk", 2)
+    a.remove_item("milk", 1)
+    copy = ShoppingListORSet()
+    copy.deserialize(a.serialize())
+    assert copy.listID == "list"
+    assert state(copy) == state(a)
+    assert copy.serialize() == a.serialize()
+
+def old_tag():
+    return f"{uuid.uuid4()}-{datetime.now().isoformat()}"
+
+def test_read_add_set_format():
+    old = {
+        "listID": "list",
+        "add_set": [["milk", 3, old_tag()], ["eggs", 6, old_tag()], ["milk", 1, old_tag()]],
+        "remove_set": [["milk", 2, old_tag()]],
+    }
+    shopping_list = replica("a")
+    shopping_list.deserialize(old)
+    assert dict(shopping_list.get_list()) == {"milk": 2, "eggs": 6}
+    assert len(shopping_list.vv) == 4
+    # New changes go on top of the old ones, and the result reads back in the new format
+    shopping_list.add_item("eggs", 6)
+    copy = replica("b")
+    copy.deserialize(shopping_list.serialize())
+    assert dict(copy.get_list()) == {"milk": 2, "eggs": 12}
+
+def test_merge_add_set_format_is_idempotent():
+    old = {"listID": "list", "add_set": [["milk", 3, old_tag()]], "remove_set": []}
+    shopping_list = replica("a")
+    shopping_list.merge(old)
+    shopping_list.merge(old)
+    assert dict(shopping_list.get_list()) == {"milk": 3}
@@ -0,0 +1,20 @@
+from peers import PeerStats, PEER_TIMEOUT, LATENCY_MIN_SAMPLES
+
+def test_timeouts_stay_out_of_the_reply_times():
+    stats = PeerStats()
+    for _ in range(LATENCY_MIN_SAMPLES):
+        stats.record(0.01)
+    for _ in range(LATENCY_MIN_SAMPLES):
+        stats.fail()
+    assert stats.p95() == 0.01
+    assert stats.average == 0.01
+    assert stats.failures == LATENCY_MIN_SAMPLES
+    assert stats.failed >= stats.updated
+    assert stats.p95() < PEER_TIMEOUT
+
+def test_reply_after_a_failure_marks_the_peer_answering_again():
+    stats = PeerStats()
+    stats.fail()
+    stats.record(0.02)
+    assert stats.updated >= stats.failed
+    assert len(stats.samples) == 1